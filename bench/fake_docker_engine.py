@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""
+Stand-in for the Docker Engine API on a unix socket, for benchmarking
+warpdrive's DockerClient without a docker daemon. Answers the calls
+DockerClient makes with canned data, and honours the same environment
+variables as bench/fake-docker:
+
+FAKE_DOCKER_DELAY        seconds added to every request (default 0)
+FAKE_DOCKER_BUILD_DELAY  seconds a build takes (default 0.2)
+FAKE_DOCKER_CONTAINERS   number of containers listed (default 1),
+                         named galaxy, galaxy_1, galaxy_2, ...
+FAKE_DOCKER_LAYER_SIZE   bytes in the layer of a saved image (default 1 MB)
+FAKE_DOCKER_API_VERSION  API version the daemon reports (default 1.41)
+
+    python bench/fake_docker_engine.py /tmp/docker.sock
+"""
+
+import sys
+import os
+import re
+import time
+import json
+import hashlib
+import tarfile
+import threading
+import urllib
+import urlparse
+import StringIO
+import BaseHTTPServer
+import SocketServer
+
+
+def env_delay():
+    return float(os.environ.get("FAKE_DOCKER_DELAY", "0"))
+
+
+def env_containers():
+    return int(os.environ.get("FAKE_DOCKER_CONTAINERS", "1"))
+
+
+def container_names():
+    for i in range(env_containers()):
+        yield "galaxy" if i == 0 else "galaxy_%d" % (i)
+
+
+def image_id(tag):
+    return "sha256:" + hashlib.sha256(tag).hexdigest()
+
+
+def write_image_archive(tag, handle):
+    """
+    Write a 'docker save'-style archive of tag to handle: a manifest, an
+    image config and one layer of FAKE_DOCKER_LAYER_SIZE bytes.
+    """
+    size = int(os.environ.get("FAKE_DOCKER_LAYER_SIZE", str(1024 * 1024)))
+    digest = image_id(tag)[7:]
+    layer_dir = hashlib.sha256("layer:" + tag).hexdigest()
+    block = "".join( hashlib.sha256("%s:%d" % (tag, i)).hexdigest() for i in range(128) )
+    layer = (block * (size // len(block) + 1))[:size]
+    members = [
+        ("manifest.json", json.dumps([{"RepoTags" : [tag], "Config" : digest + ".json",
+            "Layers" : [layer_dir + "/layer.tar"]}])),
+        (digest + ".json", json.dumps({"config" : {}, "rootfs" : {"type" : "layers"}})),
+        (layer_dir + "/layer.tar", layer)
+    ]
+    tar = tarfile.open(fileobj=handle, mode="w|")
+    for name, data in members:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        tar.addfile(info, StringIO.StringIO(data))
+    tar.close()
+
+
+def container_record(i, name):
+    return {
+        "Id" : hashlib.sha256(name).hexdigest(),
+        "Names" : ["/" + name],
+        "Image" : "bgruening/galaxy-stable",
+        "Command" : "/usr/bin/startup",
+        "Created" : 1462295554,
+        "Ports" : [{"IP" : "0.0.0.0", "PrivatePort" : 80, "PublicPort" : 8080 + i, "Type" : "tcp"}],
+        "State" : "running",
+        "Status" : "Up 5 minutes"
+    }
+
+
+class ThreadedUnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        #keep-alive connections left open by the client end this way
+        pass
+
+
+class FakeEngineHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '') == "chunked":
+            size = 0
+            while True:
+                length = int(self.rfile.readline().strip(), 16)
+                if length == 0:
+                    self.rfile.readline()
+                    return size
+                size += len(self.rfile.read(length))
+                self.rfile.readline()
+        length = int(self.headers.get('Content-Length', 0))
+        return len(self.rfile.read(length))
+
+    def send(self, status, data=None, content_type="application/json"):
+        if data is None:
+            text = ""
+        elif not isinstance(data, basestring):
+            text = json.dumps(data)
+        else:
+            text = data
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def send_stream(self, messages):
+        self.send(200, "".join( json.dumps(a) + "\r\n" for a in messages ))
+
+    def send_tar(self, write):
+        out = StringIO.StringIO()
+        write(out)
+        self.send(200, out.getvalue(), "application/x-tar")
+
+    def dispatch(self, method):
+        delay = env_delay()
+        if delay:
+            time.sleep(delay)
+        u = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(u.query))
+        path = urllib.unquote(u.path)
+        m = re.match(r"^/v([\d.]+)(/.*)$", path)
+        if m:
+            path = m.group(2)
+        body_size = self.read_body()
+
+        if path == "/version":
+            version = os.environ.get("FAKE_DOCKER_API_VERSION", "1.41")
+            return self.send(200, {"ApiVersion" : version, "MinAPIVersion" : "1.12", "Version" : "20.10.0-fake"})
+        if path == "/_ping":
+            return self.send(200, "OK", "text/plain")
+
+        if path == "/containers/json":
+            filters = json.loads(params.get('filters', '{}')).get('name', [])
+            filters = list( re.compile(a) for a in filters )
+            out = []
+            for i, name in enumerate(container_names()):
+                if len(filters) and not any(f.search("/" + name) for f in filters):
+                    continue
+                out.append(container_record(i, name))
+            return self.send(200, out)
+        if path == "/containers/create":
+            return self.send(201, {"Id" : hashlib.sha256(params.get('name', '') + str(time.time())).hexdigest()})
+        m = re.match(r"^/containers/([^/]+)(/(\w+))?$", path)
+        if m:
+            name, action = m.group(1), m.group(3)
+            if action == "json":
+                if name not in container_names():
+                    return self.send(404, {"message" : "No such container: %s" % (name)})
+                return self.send(200, {
+                    "Id" : hashlib.sha256(name).hexdigest(),
+                    "Name" : "/" + name,
+                    "State" : {"Status" : "running", "Running" : True, "ExitCode" : 0}
+                })
+            if action == "archive":
+                return self.send_tar(lambda out: tarfile.open(fileobj=out, mode="w|").close())
+            if action == "attach":
+                return self.send(200, "", "application/vnd.docker.raw-stream")
+            if action in (None, "start", "kill", "stop"):
+                return self.send(204)
+
+        if path == "/build":
+            time.sleep(float(os.environ.get("FAKE_DOCKER_BUILD_DELAY", "0.2")))
+            return self.send_stream([
+                {"stream" : "Sending build context (%d bytes)\n" % (body_size)},
+                {"stream" : "Successfully built %s\n" % (image_id(params.get('t', ''))[7:19])}
+            ])
+        if path == "/images/create":
+            return self.send_stream([{"status" : "Pulling from %s" % (params.get('fromImage', ''))}])
+        if path == "/images/load":
+            return self.send_stream([{"stream" : "Loaded image (%d bytes)\n" % (body_size)}])
+        m = re.match(r"^/images/(.+)/(json|get)$", path)
+        if m:
+            if m.group(2) == "json":
+                return self.send(200, {"Id" : image_id(m.group(1))})
+            return self.send_tar(lambda out: write_image_archive(m.group(1), out))
+
+        return self.send(404, {"message" : "page not found: %s" % (path)})
+
+
+class FakeDockerEngine(object):
+    """
+    Serves FakeEngineHandler on a unix socket at path; point DOCKER_HOST at
+    unix://<path> to use it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            os.unlink(path)
+        self.server = ThreadedUnixServer(path, FakeEngineHandler)
+        self.thread = None
+
+    @property
+    def url(self):
+        return "unix://" + self.path
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+if __name__ == "__main__":
+    engine = FakeDockerEngine(sys.argv[1])
+    try:
+        engine.server.serve_forever()
+    finally:
+        os.unlink(engine.path)
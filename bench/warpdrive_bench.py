@@ -0,0 +1,661 @@
+#!/usr/bin/env python
+"""
+Offline benchmarks for warpdrive.
+
+Runs against a local fake Galaxy API server (FakeGalaxy, with configurable
+per-request latency), the fake docker CLI in bench/fake-docker and the fake
+Engine API socket in bench/fake_docker_engine.py, so no Galaxy container or
+docker daemon is needed. Benchmarks that talk to docker run once through
+the CLI and once through the API; the API figures carry an _api suffix.
+Results are compared with the stored baselines in bench/baselines.json, and
+the run fails if a metric is worse than its baseline by more than
+--tolerance.
+
+    python bench/warpdrive_bench.py                    # run all, compare
+    python bench/warpdrive_bench.py -b ingest -b scan  # run some
+    python bench/warpdrive_bench.py --save-baseline    # record baselines
+
+Baselines are machine specific; re-record them on the machine that runs
+the comparison.
+"""
+
+import sys
+import os
+import re
+import time
+import json
+import shutil
+import tempfile
+import argparse
+import platform
+import threading
+import contextlib
+import logging
+import urlparse
+import StringIO
+import BaseHTTPServer
+import SocketServer
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINES = os.path.join(BENCH_DIR, "baselines.json")
+WORK_DIR = tempfile.mkdtemp(prefix="warpdrive_bench_")
+
+#warpdrive reads these at import and on first docker call
+os.environ['WARPDRIVE_CONFIG_DIR'] = os.path.join(WORK_DIR, "config")
+os.environ.pop('DOCKER_HOST', None)
+os.environ.pop('DOCKER_TLS_VERIFY', None)
+BIN_DIR = os.path.join(WORK_DIR, "bin")
+os.mkdir(BIN_DIR)
+with open(os.path.join(BIN_DIR, "docker"), "w") as handle:
+    handle.write("#!/bin/sh\nexec '%s' '%s' \"$@\"\n" % (sys.executable, os.path.join(BENCH_DIR, "fake-docker")))
+os.chmod(os.path.join(BIN_DIR, "docker"), 0755)
+os.environ['PATH'] = BIN_DIR + ":" + os.environ['PATH']
+
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+import warpdrive
+from fake_docker_engine import FakeDockerEngine
+
+DOCKER_BACKENDS = [('cli', ""), ('api', "_api")]
+
+
+@contextlib.contextmanager
+def docker_backend(mode):
+    """
+    Route warpdrive's docker calls through the fake CLI ('cli') or the fake
+    Engine API socket ('api').
+    """
+    engine = None
+    os.environ['WARPDRIVE_DOCKER'] = mode
+    if mode == "api":
+        engine = FakeDockerEngine(os.path.join(WORK_DIR, "docker.sock")).start()
+        os.environ['DOCKER_HOST'] = engine.url
+    warpdrive.DOCKER_CLIENTS.clear()
+    try:
+        yield
+    finally:
+        warpdrive.DOCKER_CLIENTS.clear()
+        os.environ.pop('DOCKER_HOST', None)
+        if engine is not None:
+            engine.stop()
+
+
+"""
+Code for the fake Galaxy API
+"""
+
+def galaxy_id(n):
+    return "%016x" % (n)
+
+
+class FakeGalaxy(object):
+    """
+    In-memory Galaxy answering the API calls RemoteGalaxy makes: libraries
+    and their contents, histories, datasets (with Range downloads),
+    provenance, jobs and workflows. Every request is delayed by latency
+    seconds, dataset downloads are limited to bandwidth bytes/sec on each
+    connection, and /api/version fails until ready_after seconds have passed
+    since start.
+    """
+
+    def __init__(self, latency=0.0, ready_after=0.0, history_size=10, dataset_size=1024*1024, port=0,
+        bandwidth=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.ready_after = ready_after
+        self.history_size = history_size
+        self.dataset_size = dataset_size
+        self.blob = "".join(chr(i % 251) for i in range(1024 * 1024))
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.libraries = {}
+        self.server = ThreadedHTTPServer(("127.0.0.1", port), FakeGalaxyHandler)
+        self.server.galaxy = self
+        self.started = None
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % (self.server.server_port)
+
+    def start(self):
+        self.started = time.time()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def new_id(self):
+        with self.lock:
+            n = self.next_id
+            self.next_id += 1
+        return galaxy_id(n)
+
+    def dataset(self, history, hid):
+        return {
+            'id' : galaxy_id(0x100000 + hid),
+            'hid' : hid,
+            'name' : "dataset_%d.txt" % (hid),
+            'extension' : 'txt',
+            'file_size' : self.dataset_size,
+            'state' : 'ok',
+            'deleted' : False,
+            'purged' : False,
+            'visible' : True,
+            'history_id' : history,
+            'history_content_type' : 'dataset',
+            'creating_job' : galaxy_id(0x200000 + hid),
+            'download_url' : "/api/histories/%s/contents/%s/display" % (history, galaxy_id(0x100000 + hid))
+        }
+
+    def handle(self, method, path, params, body):
+        """
+        Returns (status, JSON-able body) for an API call, or (status, None,
+        size, offset) for a dataset download.
+        """
+        if path == "/api/version":
+            if time.time() - self.started < self.ready_after:
+                return 502, {'err_msg' : 'starting'}
+            return 200, {'version_major' : '16.04'}
+
+        if path == "/api/libraries":
+            if method == "POST":
+                lid = self.new_id()
+                lib = {'id' : lid, 'name' : body['name'], 'contents' : [{'id' : "F" + lid, 'name' : "/", 'type' : 'folder'}]}
+                with self.lock:
+                    self.libraries[lid] = lib
+                return 200, {'id' : lid, 'name' : lib['name']}
+            with self.lock:
+                return 200, list( {'id' : a['id'], 'name' : a['name']} for a in self.libraries.values() )
+
+        m = re.match(r"^/api/libraries/(\w+)/contents(/(\w+))?$", path)
+        if m:
+            lib = self.libraries.get(m.group(1), None)
+            if lib is None:
+                return 404, {'err_msg' : 'no library'}
+            if method == "POST":
+                out = []
+                for p in body['filesystem_paths'].split("\n"):
+                    item = {'id' : self.new_id(), 'name' : "/" + os.path.basename(p), 'type' : 'file', 'url' : p}
+                    out.append(item)
+                with self.lock:
+                    lib['contents'].extend(out)
+                return 200, out
+            if m.group(3) is not None:
+                for a in lib['contents']:
+                    if a['id'] == m.group(3):
+                        return 200, a
+                return 404, {'err_msg' : 'no item'}
+            with self.lock:
+                contents = list(lib['contents'])
+            if 'limit' in params:
+                offset = int(params.get('offset', 0))
+                contents = contents[offset:offset + int(params['limit'])]
+            return 200, contents
+
+        if path == "/api/histories":
+            return 200, [{'id' : galaxy_id(1), 'name' : 'bench'}]
+
+        m = re.match(r"^/api/histories/(\w+)(/contents(/(\w+)(/(display|provenance))?)?)?$", path)
+        if m:
+            history = m.group(1)
+            if m.group(2) is None:
+                return 200, {'id' : history, 'name' : 'bench'}
+            if m.group(3) is None:
+                return 200, list( self.dataset(history, hid) for hid in range(1, self.history_size + 1) )
+            hid = int(m.group(4), 16) - 0x100000
+            if m.group(6) == "display":
+                return 200, None
+            if m.group(6) == "provenance":
+                return 200, {'job_id' : galaxy_id(0x200000 + hid), 'tool_id' : 'cat1'}
+            return 200, self.dataset(history, hid)
+
+        m = re.match(r"^/api/datasets/(\w+)$", path)
+        if m:
+            return 200, self.dataset(galaxy_id(1), int(m.group(1), 16) - 0x100000)
+
+        m = re.match(r"^/api/jobs/(\w+)$", path)
+        if m:
+            return 200, {'id' : m.group(1), 'state' : 'ok', 'tool_id' : 'cat1', 'tool_version' : '1.0', 'inputs' : {}}
+
+        if path == "/api/workflows/upload":
+            return 200, {'id' : self.new_id()}
+        if path == "/api/workflows" and method == "POST":
+            #like Galaxy, 'history' names a new history unless it is hist_id=<id>
+            history = body.get('history', None)
+            if history is None:
+                history = galaxy_id(1)
+            elif history.startswith("hist_id="):
+                history = history[len("hist_id="):]
+            else:
+                history = self.new_id()
+            return 200, {'id' : self.new_id(), 'history_id' : history,
+                'steps' : [{'job_id' : self.new_id()}]}
+        m = re.match(r"^/api/workflows/(\w+)$", path)
+        if m:
+            return 200, {'id' : m.group(1), 'inputs' : {'0' : {'label' : 'input'}}}
+
+        return 404, {'err_msg' : 'unknown endpoint %s' % (path)}
+
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class FakeGalaxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    #send each response in one write, without waiting on delayed ACKs
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def dispatch(self, method):
+        galaxy = self.server.galaxy
+        if galaxy.latency:
+            time.sleep(galaxy.latency)
+        u = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(u.query))
+        body = None
+        if method == "POST":
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        status, data = galaxy.handle(method, u.path, params, body)
+        if data is None:
+            self.send_dataset(galaxy)
+            return
+        text = json.dumps(data)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def send_dataset(self, galaxy):
+        size = galaxy.dataset_size
+        start, end = 0, size - 1
+        m = re.match(r"^bytes=(\d+)-(\d*)$", self.headers.get('Range', ''))
+        if m:
+            start = int(m.group(1))
+            if len(m.group(2)):
+                end = min(int(m.group(2)), size - 1)
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        blob = galaxy.blob
+        step = len(blob) if galaxy.bandwidth is None else 64 * 1024
+        began = time.time()
+        pos = start
+        while pos <= end:
+            offset = pos % len(blob)
+            chunk = blob[offset:offset + min(step, len(blob) - offset, end - pos + 1)]
+            self.wfile.write(chunk)
+            pos += len(chunk)
+            if galaxy.bandwidth is not None:
+                lag = began + float(pos - start) / galaxy.bandwidth - time.time()
+                if lag > 0:
+                    time.sleep(lag)
+
+
+"""
+Code for the benchmarks
+"""
+
+@contextlib.contextmanager
+def quiet():
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        yield
+    finally:
+        sys.stdout = stdout
+
+
+def best_of(repeat, func):
+    """
+    Run func repeat times and return the shortest wall time.
+    """
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def make_tree(path, dirs, files_per_dir, sidecars=True):
+    if os.path.exists(path):
+        return path
+    for d in range(dirs):
+        dpath = os.path.join(path, "dir_%03d" % (d))
+        os.makedirs(dpath)
+        for f in range(files_per_dir):
+            fpath = os.path.join(dpath, "sample_%04d.txt" % (f))
+            with open(fpath, "w") as handle:
+                handle.write("%d\n" % (f))
+            if sidecars and f % 2 == 0:
+                with open(fpath + ".json", "w") as handle:
+                    handle.write(json.dumps({'sample' : f, 'dir' : d}))
+    return path
+
+
+@contextlib.contextmanager
+def slow_listing(latency):
+    """
+    Delay every directory listing warpdrive makes by latency seconds, like
+    the round trip of a network filesystem.
+    """
+    list_directory = warpdrive.list_directory
+
+    def slow(path):
+        time.sleep(latency)
+        return list_directory(path)
+    warpdrive.list_directory = slow
+    try:
+        yield
+    finally:
+        warpdrive.list_directory = list_directory
+
+
+def bench_scan(scale):
+    """
+    Directory scanning with half the files carrying .json sidecars. The rate
+    is for a serial scan of local disk; parallel scanning only pays off when
+    listing waits on I/O, so it is reported as the speedup of 4 workers over
+    1 with 5 ms added to each directory listing.
+    """
+    dirs = max(1, int(200 * scale))
+    tree = make_tree(os.path.join(WORK_DIR, "scan_%d" % (dirs)), dirs, 100)
+    files = [0]
+
+    def scan(workers):
+        def run():
+            data_load, meta_data = warpdrive.scan_directory(tree, ".json", workers=workers, metadata_workers=workers)
+            files[0] = len(data_load)
+        return run
+
+    serial = best_of(3, scan(1))
+    with slow_listing(0.005):
+        slow_serial = best_of(3, scan(1))
+        slow_parallel = best_of(3, scan(4))
+    return {
+        'scan_files_per_sec' : (files[0] / serial, "files/s", "higher"),
+        'scan_parallel_speedup' : (slow_serial / slow_parallel, "x", "higher")
+    }
+
+
+def bench_ingest(scale):
+    """
+    Library paste rate of ingest_files against a server with 5 ms latency.
+    """
+    dirs = max(1, int(50 * scale))
+    tree = make_tree(os.path.join(WORK_DIR, "ingest_%d" % (dirs)), dirs, 100, sidecars=False)
+    galaxy = FakeGalaxy(latency=0.005).start()
+    try:
+        rg = warpdrive.RemoteGalaxy(galaxy.url, "key", path_mapping={tree : "/parent/lib_data_0"}, pool_size=8)
+        out = {}
+        for batch_size, key in [(100, 'ingest_files_per_sec'), (1, 'ingest_single_files_per_sec')]:
+            library_id = rg.create_library("bench_%d" % (batch_size))
+            folder_id = rg.library_find_contents(library_id, "/")['id']
+            start = time.time()
+            pasted, failed = warpdrive.ingest_files(rg, library_id, folder_id,
+                warpdrive.iter_directory(tree), batch_size=batch_size, workers=4)
+            elapsed = time.time() - start
+            if len(failed):
+                raise Exception("%d files failed to ingest" % (len(failed)))
+            out[key] = (pasted / elapsed, "files/s", "higher")
+        return out
+    finally:
+        galaxy.stop()
+
+
+def bench_readiness(scale):
+    """
+    Time between Galaxy starting to answer and wait_for_galaxy noticing, with
+    the container state checked through docker.
+    """
+    ready_after = 1.0
+    out = {}
+    for mode, suffix in DOCKER_BACKENDS:
+        lags = []
+        with docker_backend(mode):
+            for i in range(3):
+                galaxy = FakeGalaxy(ready_after=ready_after).start()
+                try:
+                    ready = warpdrive.wait_for_galaxy(galaxy.url, timeout=30, name="galaxy", check_interval=0.5)
+                finally:
+                    galaxy.stop()
+                lags.append(ready - ready_after)
+        out['readiness_lag_sec' + suffix] = (min(lags), "s", "lower")
+    return out
+
+
+def bench_status(scale):
+    """
+    run_status for many instances from one name-filtered ps call, and raw
+    parsing of 'docker ps' JSON lines.
+    """
+    count = max(1, int(100 * scale))
+    os.environ['FAKE_DOCKER_CONTAINERS'] = str(count)
+    names = ["galaxy"] + list( "galaxy_%d" % (i) for i in range(1, count) )
+    out = {}
+    try:
+        for mode, suffix in DOCKER_BACKENDS:
+            with docker_backend(mode):
+                elapsed = best_of(5, lambda: warpdrive.run_status(name=names, ready=False))
+            out['status_instances_per_sec' + suffix] = (count / elapsed, "instances/s", "higher")
+    finally:
+        del os.environ['FAKE_DOCKER_CONTAINERS']
+    line = {
+        "CreatedAt" : "2016-05-03 10:12:34 -0700 PDT", "ID" : "0" * 64, "Image" : "bgruening/galaxy-stable",
+        "Names" : "galaxy", "Ports" : "0.0.0.0:8080->80/tcp, :::8080->80/tcp", "Status" : "Up 5 minutes"
+    }
+    lines = list( json.dumps(dict(line, Names="galaxy_%d" % (i))) for i in range(10000) )
+    parse = best_of(3, lambda: list( warpdrive.docker_cli_record(json.loads(a)) for a in lines ))
+    out['status_parse_records_per_sec'] = (len(lines) / parse, "records/s", "higher")
+    return out
+
+
+def time_download(size, segments, bandwidth=None):
+    galaxy = FakeGalaxy(dataset_size=size, bandwidth=bandwidth).start()
+    try:
+        rg = warpdrive.RemoteGalaxy(galaxy.url, "key")
+        meta = rg.get_hda(galaxy_id(1), galaxy_id(0x100001))
+        dst = os.path.join(WORK_DIR, "download.dat")
+        elapsed = best_of(3, lambda: rg.download(meta['download_url'], dst, segments=segments))
+        if os.path.getsize(dst) != size:
+            raise Exception("Downloaded %d of %d bytes" % (os.path.getsize(dst), size))
+        os.unlink(dst)
+        return elapsed
+    finally:
+        galaxy.stop()
+
+
+def bench_download(scale):
+    """
+    Dataset download throughput of one stream from a local server. Ranged
+    segments only pay off when each connection is throttled, so they are
+    reported as the speedup of 4 segments over 1 from a server limited to
+    32 MB/s per connection.
+    """
+    size = max(1024 * 1024, int(64 * 1024 * 1024 * scale))
+    limited = max(1024 * 1024, int(16 * 1024 * 1024 * scale))
+    return {
+        'download_mb_per_sec' : (size / time_download(size, 1) / 1048576, "MB/s", "higher"),
+        'download_segmented_speedup' : (time_download(limited, 1, 32 * 1048576) /
+            time_download(limited, 4, 32 * 1048576), "x", "higher")
+    }
+
+
+def bench_build(scale):
+    """
+    run_build of 8 tool images taking 0.2 s each, serially and with 4 jobs.
+    Reported as the parallel speedup over the serial build.
+    """
+    tool_dir = os.path.join(WORK_DIR, "tools")
+    if not os.path.exists(tool_dir):
+        for i in range(8):
+            d = os.path.join(tool_dir, "tool_%d" % (i))
+            os.makedirs(d)
+            with open(os.path.join(d, "tool_%d.xml" % (i)), "w") as handle:
+                handle.write('<tool id="tool_%d" name="Tool %d" version="1.0"><requirements>'
+                    '<container type="docker">bench_tool_%d:1.0</container></requirements></tool>' % (i, i, i))
+            with open(os.path.join(d, "Dockerfile"), "w") as handle:
+                handle.write("FROM busybox\n")
+    image_dir = os.path.join(WORK_DIR, "images")
+    out = {}
+    for mode, suffix in DOCKER_BACKENDS:
+        times = {}
+        with docker_backend(mode):
+            for jobs in (1, 4):
+                def run():
+                    with quiet():
+                        warpdrive.run_build(tool_dir, no_cache=True, image_dir=image_dir, jobs=jobs)
+                times[jobs] = best_of(1, run)
+        out['build_seconds' + suffix] = (times[4], "s", "lower")
+        out['build_parallel_speedup' + suffix] = (times[1] / times[4], "x", "higher")
+    return out
+
+
+def bench_export(scale):
+    """
+    Image export through 'docker save' streamed into gzip and into the
+    layer store, and loading the layered archives back, for 4 images with an
+    8 MB layer each. Rates are MB of image archive per second.
+    """
+    layer_size = max(1024 * 1024, int(8 * 1024 * 1024 * scale))
+    tags = list( "bench_export_%d:1.0" % (i) for i in range(4) )
+    total = len(tags) * layer_size / 1048576.0
+    os.environ['FAKE_DOCKER_LAYER_SIZE'] = str(layer_size)
+    out = {}
+    try:
+        for mode, suffix in DOCKER_BACKENDS:
+            image_dir = os.path.join(WORK_DIR, "export_" + mode)
+            os.mkdir(image_dir)
+            with docker_backend(mode):
+                def export(compress, layer_store):
+                    def run():
+                        for tag in tags:
+                            warpdrive.export_image(tag,
+                                os.path.join(image_dir, warpdrive.image_file_name(tag, compress, layer_store)),
+                                compress=compress,
+                                layer_dir=os.path.join(image_dir, "layers") if layer_store else None)
+                    return run
+                gzip_time = best_of(1, export("gzip", False))
+                #the first layered export fills the layer store, later ones reuse it
+                layered_time = best_of(2, export(None, True))
+                with quiet():
+                    load_time = best_of(1, lambda: warpdrive.run_load(image_dir, tool=list(tags)))
+            shutil.rmtree(image_dir)
+            out['export_gzip_mb_per_sec' + suffix] = (total / gzip_time, "MB/s", "higher")
+            out['export_layered_mb_per_sec' + suffix] = (total / layered_time, "MB/s", "higher")
+            out['load_mb_per_sec' + suffix] = (total / load_time, "MB/s", "higher")
+    finally:
+        del os.environ['FAKE_DOCKER_LAYER_SIZE']
+    return out
+
+
+BENCHMARKS = [
+    ('scan', bench_scan),
+    ('ingest', bench_ingest),
+    ('readiness', bench_readiness),
+    ('status', bench_status),
+    ('download', bench_download),
+    ('build', bench_build),
+    ('export', bench_export)
+]
+
+
+def load_baselines(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as handle:
+        return json.loads(handle.read())
+
+
+def compare(results, baselines, tolerance):
+    """
+    Print each metric next to its baseline and return the names of the
+    metrics that are worse than the baseline by more than tolerance.
+    """
+    regressions = []
+    print "%-32s %12s %-11s %12s %9s" % ("metric", "value", "unit", "baseline", "change")
+    for name, (value, unit, better) in sorted(results.items()):
+        base = baselines.get('metrics', {}).get(name, None)
+        if base is None:
+            print "%-32s %12.2f %-11s %12s %9s" % (name, value, unit, "-", "-")
+            continue
+        change = (value - base['value']) / base['value'] if base['value'] else 0.0
+        worse = -change if better == "higher" else change
+        flag = ""
+        if worse > tolerance:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print "%-32s %12.2f %-11s %12.2f %+8.1f%%%s" % (name, value, unit, base['value'], change * 100, flag)
+    return regressions
+
+
+def main(benchmarks, baseline, save_baseline, tolerance, scale):
+    selected = list( (n, f) for n, f in BENCHMARKS if benchmarks is None or n in benchmarks )
+    results = {}
+    try:
+        for name, func in selected:
+            start = time.time()
+            results.update(func(scale))
+            logging.info("%s finished in %.1f sec" % (name, time.time() - start))
+    finally:
+        shutil.rmtree(WORK_DIR, True)
+
+    baselines = load_baselines(baseline)
+    if save_baseline:
+        metrics = baselines.get('metrics', {})
+        for name, (value, unit, better) in results.items():
+            metrics[name] = {'value' : round(value, 3), 'unit' : unit, 'better' : better}
+        with open(baseline, "w") as handle:
+            handle.write(json.dumps({
+                'recorded' : time.strftime("%Y-%m-%d"),
+                'python' : platform.python_version(),
+                'platform' : "%s-%s" % (platform.system(), platform.machine()),
+                'scale' : scale,
+                'metrics' : metrics
+            }, indent=2, sort_keys=True, separators=(",", " : ")) + "\n")
+        print "Saved %d baselines to %s" % (len(results), baseline)
+        return 0
+    if baselines.get('scale', scale) != scale:
+        logging.warning("Baselines were recorded at scale %s, not %s" % (baselines['scale'], scale))
+    regressions = compare(results, baselines, tolerance)
+    if len(regressions):
+        print "Regressions beyond %d%%: %s" % (tolerance * 100, ", ".join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-b", "--benchmark", dest="benchmarks", action="append", default=None,
+        choices=list(n for n, f in BENCHMARKS))
+    parser.add_argument("--baseline", default=BASELINES)
+    parser.add_argument("--save-baseline", action="store_true", default=False)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed fractional slowdown")
+    parser.add_argument("--scale", type=float, default=1.0, help="Scale the size of the workloads")
+    parser.add_argument("-v", action="store_true", default=False)
+    args = parser.parse_args()
+    if args.v:
+        logging.basicConfig(level=logging.INFO)
+    sys.exit(main(args.benchmarks, args.baseline, args.save_baseline, args.tolerance, args.scale))
@@ -9,18 +9,51 @@ import argparse
 import subprocess
 import logging
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 import tempfile
 import string
 import json
 import shutil
+import hashlib
+import math
+import gzip
+import copy
+import itertools
+import heapq
+import calendar
+import threading
+import Queue
+import httplib
+import urllib
+import socket
+import struct
+import tarfile
+import csv
+import collections
+import contextlib
 
 try:
     import yaml
 except ImportError:
     yaml = None
 
-from xml.dom.minidom import parse as parseXML
-from glob import glob
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from xml.etree import cElementTree as ElementTree
+from xml.sax.saxutils import escape, quoteattr
+from glob import glob, has_magic
 from socket import gethostname
 
 if 'WARPDRIVE_CONFIG_DIR' in os.environ:
@@ -40,11 +73,629 @@ def which(file):
         if os.path.exists(p):
             return p
 
+def write_atomic(path, data):
+    """
+    Replace path with data through a unique temp file in the same directory,
+    so concurrent writers never share a partly written file.
+    """
+    fd, tmp = tempfile.mkstemp(prefix="." + os.path.basename(path) + ".", suffix=".tmp",
+        dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "w") as handle:
+            handle.write(data)
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+DOCKER_PATH = None
+
 def get_docker_path():
-    docker_path = which('docker')
-    if docker_path is None:
-        raise Exception("Cannot find docker")
-    return docker_path
+    global DOCKER_PATH
+    if DOCKER_PATH is None:
+        DOCKER_PATH = which('docker')
+        if DOCKER_PATH is None:
+            raise Exception("Cannot find docker")
+    return DOCKER_PATH
+
+def docker_env(host):
+    if host is None:
+        return None
+    sys_env = dict(os.environ)
+    sys_env['DOCKER_HOST'] = host
+    return sys_env
+
+
+"""
+Code for timing traces
+"""
+
+class Trace(object):
+    """
+    Named timing spans and counters collected while a command runs. Spans
+    can nest and can be opened from any thread. A disabled trace records
+    nothing.
+    """
+
+    def __init__(self, enabled=True, **meta):
+        self.enabled = enabled
+        self.meta = meta
+        self.start = time.time()
+        self.spans = []
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            rec = {
+                'name' : name,
+                'start' : start - self.start,
+                'seconds' : time.time() - start,
+                'thread' : threading.current_thread().name
+            }
+            if len(args):
+                rec['args'] = args
+            with self.lock:
+                self.spans.append(rec)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def timed_iter(self, name, items):
+        """
+        Yield from items, adding the time spent producing them to the
+        counter <name>_seconds. Used for lazily consumed stages, like
+        directory scanning, that can't be wrapped in one span.
+        """
+        if not self.enabled:
+            for item in items:
+                yield item
+            return
+        items = iter(items)
+        while True:
+            start = time.time()
+            try:
+                item = next(items)
+            except StopIteration:
+                self.count(name + "_seconds", time.time() - start)
+                return
+            self.count(name + "_seconds", time.time() - start)
+            self.count(name + "_items")
+            yield item
+
+    def to_json(self):
+        with self.lock:
+            return {
+                'meta' : self.meta,
+                'started' : self.start,
+                'seconds' : time.time() - self.start,
+                'spans' : sorted(self.spans, key=lambda a: a['start']),
+                'counters' : dict(self.counters)
+            }
+
+    def to_chrome(self):
+        """
+        The trace in the Chrome trace-event format, for chrome://tracing or
+        Perfetto.
+        """
+        data = self.to_json()
+        pid = os.getpid()
+        tids = {}
+        events = []
+        for rec in data['spans']:
+            tid = tids.setdefault(rec['thread'], len(tids) + 1)
+            events.append({
+                'name' : rec['name'], 'ph' : 'X', 'pid' : pid, 'tid' : tid,
+                'ts' : int(rec['start'] * 1e6), 'dur' : int(rec['seconds'] * 1e6),
+                'args' : rec.get('args', {})
+            })
+        for thread, tid in tids.items():
+            events.append({'name' : 'thread_name', 'ph' : 'M', 'pid' : pid, 'tid' : tid, 'args' : {'name' : thread}})
+        if len(data['counters']):
+            events.append({'name' : 'counters', 'ph' : 'C', 'pid' : pid, 'tid' : 0,
+                'ts' : int(data['seconds'] * 1e6), 'args' : data['counters']})
+        return {'traceEvents' : events, 'otherData' : data['meta']}
+
+    def save(self, path, format="json"):
+        data = self.to_chrome() if format == "chrome" else self.to_json()
+        with open(path, "w") as handle:
+            handle.write(json.dumps(data, indent=2, default=str))
+
+
+TRACE = Trace(enabled=False)
+
+
+@contextlib.contextmanager
+def profile_trace(format, out_dir, command, **meta):
+    """
+    With format set ('json' or 'chrome'), collect a Trace while the block
+    runs and write it to out_dir as profile_<command>_<time>.json. If
+    out_dir is gone by then (down --rm) the trace goes to its parent.
+    """
+    global TRACE
+    if format is None:
+        yield TRACE
+        return
+    prev = TRACE
+    TRACE = Trace(command=command, format=format, **meta)
+    try:
+        with TRACE.span(command):
+            yield TRACE
+    finally:
+        trace, TRACE = TRACE, prev
+        if not os.path.isdir(out_dir):
+            out_dir = os.path.dirname(out_dir)
+        path = os.path.join(out_dir, "profile_%s_%s.json" % (command, time.strftime("%Y%m%d-%H%M%S")))
+        trace.save(path, format)
+        logging.info("Wrote %s trace to %s" % (format, path))
+
+
+"""
+Code for talking to the Docker Engine API
+"""
+
+#the API version the client is written against; older daemons are spoken to
+#in their own version, newer ones that no longer accept it in their oldest
+DOCKER_API_VERSION = "1.24"
+DOCKER_SOCKET = "/var/run/docker.sock"
+
+class DockerAPIError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, "Docker API error %s: %s" % (status, message))
+        self.status = status
+        self.message = message
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+
+    def __init__(self, path, timeout=None):
+        httplib.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+def api_version_tuple(version):
+    return tuple( int(a) for a in version.lstrip("v").split(".") )
+
+
+class DockerClient(object):
+    """
+    Minimal Docker Engine API client. Each thread keeps its own keep-alive
+    connection to the daemon; streaming calls (build, save, attach, pull)
+    use a dedicated connection so they don't hold up the shared one. With
+    no version given, ping() negotiates one with the daemon.
+    """
+
+    def __init__(self, host=None, version=None):
+        if host is None:
+            host = os.environ.get("DOCKER_HOST", "unix://" + DOCKER_SOCKET)
+        u = urlparse.urlparse(host)
+        if u.scheme == "unix" or u.scheme == "":
+            self.socket_path = u.path
+            self.address = None
+        elif u.scheme in ["tcp", "http"]:
+            self.socket_path = None
+            self.address = u.netloc
+        else:
+            raise ValueError("Unsupported docker host: %s" % (host))
+        self.version = version
+        self.local = threading.local()
+
+    def new_connection(self, timeout=None):
+        if self.socket_path is not None:
+            return UnixHTTPConnection(self.socket_path, timeout=timeout)
+        return httplib.HTTPConnection(self.address, timeout=timeout)
+
+    def url(self, path, params=None):
+        url = path
+        if self.version is not None:
+            url = "/v%s%s" % (self.version, path)
+        if params:
+            url += "?" + urllib.urlencode(params)
+        return url
+
+    def open(self, method, path, params=None, body=None, headers={}):
+        conn = self.new_connection()
+        conn.request(method, self.url(path, params), body, headers)
+        res = conn.getresponse()
+        if res.status >= 400:
+            raise DockerAPIError(res.status, self.error_message(res.read()))
+        return res
+
+    def request(self, method, path, params=None, body=None, headers={}):
+        url = self.url(path, params)
+        for attempt in range(2):
+            conn = getattr(self.local, "conn", None)
+            if conn is None:
+                conn = self.new_connection()
+                self.local.conn = conn
+            try:
+                conn.request(method, url, body, headers)
+                res = conn.getresponse()
+                data = res.read()
+                break
+            except (httplib.HTTPException, socket.error):
+                #the daemon may have closed an idle keep-alive connection
+                conn.close()
+                self.local.conn = None
+                if attempt:
+                    raise
+        if res.status >= 400:
+            raise DockerAPIError(res.status, self.error_message(data))
+        if len(data) and res.getheader("Content-Type", "").startswith("application/json"):
+            return json.loads(data)
+        return data
+
+    def error_message(self, data):
+        try:
+            return json.loads(data)['message']
+        except (ValueError, KeyError, TypeError):
+            return data.strip()
+
+    def negotiate_version(self):
+        """
+        Pick the API version from the daemon's unversioned /version: ours,
+        unless the daemon is older or no longer accepts it.
+        """
+        version, self.version = self.version, None
+        try:
+            info = self.request("GET", "/version")
+        finally:
+            self.version = version
+        if not isinstance(info, dict):
+            info = json.loads(info)
+        server = info.get('ApiVersion', DOCKER_API_VERSION)
+        minimum = info.get('MinAPIVersion', server)
+        if api_version_tuple(server) < api_version_tuple(DOCKER_API_VERSION):
+            return server
+        if api_version_tuple(minimum) > api_version_tuple(DOCKER_API_VERSION):
+            return minimum
+        return DOCKER_API_VERSION
+
+    def ping(self):
+        try:
+            if self.version is None:
+                self.version = self.negotiate_version()
+                logging.debug("Using docker API version %s" % (self.version))
+            return self.request("GET", "/_ping") == "OK"
+        except (DockerAPIError, httplib.HTTPException, socket.error, ValueError):
+            return False
+
+    def read_stream(self, res):
+        decoder = json.JSONDecoder()
+        buf = ""
+        while True:
+            chunk = res.read(8192)
+            if not chunk:
+                break
+            buf += chunk
+            while True:
+                buf = buf.lstrip()
+                if not len(buf):
+                    break
+                try:
+                    msg, end = decoder.raw_decode(buf)
+                except ValueError:
+                    break
+                buf = buf[end:]
+                if 'error' in msg:
+                    raise DockerAPIError(500, msg['error'])
+                yield msg
+
+    def pull(self, image):
+        repo, tag = image, "latest"
+        if ":" in image and "/" not in image.rsplit(":", 1)[1]:
+            repo, tag = image.rsplit(":", 1)
+        logging.info("pulling: %s" % (image))
+        res = self.open("POST", "/images/create", {'fromImage' : repo, 'tag' : tag})
+        for msg in self.read_stream(res):
+            logging.debug(msg.get('status', ''))
+
+    def run(self, image, ports={}, args=[], env={}, set_user=False, mounts={}, privledged=False, name=None):
+        port_bindings = {}
+        for k, v in ports.items():
+            cport = str(v) if "/" in str(v) else "%s/tcp" % (v)
+            port_bindings.setdefault(cport, []).append({'HostPort' : str(k)})
+        config = {
+            'Image' : image,
+            'Env' : list("%s=%s" % (k,v) for k,v in env.items()),
+            'ExposedPorts' : dict( (k, {}) for k in port_bindings ),
+            'HostConfig' : {
+                'PortBindings' : port_bindings,
+                'Binds' : list("%s:%s" % (k, v) for k, v in mounts.items()),
+                'Privileged' : privledged
+            }
+        }
+        if len(args):
+            config['Cmd'] = args
+        if set_user:
+            config['User'] = str(os.geteuid())
+        params = {}
+        if name is not None:
+            params['name'] = name
+        body = json.dumps(config)
+        headers = {'Content-Type' : 'application/json'}
+        try:
+            out = self.request("POST", "/containers/create", params, body, headers)
+        except DockerAPIError, e:
+            if e.status != 404:
+                raise
+            self.pull(image)
+            out = self.request("POST", "/containers/create", params, body, headers)
+        self.request("POST", "/containers/%s/start" % (out['Id']))
+        return out['Id']
+
+    def attach(self, name):
+        res = self.open("POST", "/containers/%s/attach" % (name), {'stream' : 1, 'stdout' : 1, 'stderr' : 1})
+        outputs = {1 : sys.stdout, 2 : sys.stderr}
+        while True:
+            header = res.read(8)
+            if len(header) < 8:
+                break
+            size = struct.unpack(">BxxxL", header)
+            data = res.read(size[1])
+            out = outputs.get(size[0], sys.stdout)
+            out.write(data)
+            out.flush()
+
+    def copy(self, name, path, dst):
+        res = self.open("GET", "/containers/%s/archive" % (name), {'path' : path})
+        root = os.path.basename(path.rstrip("/"))
+        tar = tarfile.open(fileobj=res, mode="r|")
+        if os.path.isdir(dst):
+            tar.extractall(dst)
+        else:
+            for member in tar:
+                member.name = os.path.basename(dst) + member.name[len(root):]
+                tar.extract(member, os.path.dirname(os.path.abspath(dst)))
+        tar.close()
+
+    def kill(self, name):
+        self.request("POST", "/containers/%s/kill" % (name))
+
+    def rm(self, name, volume_delete=False):
+        self.request("DELETE", "/containers/%s" % (name), {'v' : int(volume_delete)})
+
+    def inspect(self, name):
+        try:
+            return self.request("GET", "/containers/%s/json" % (name))
+        except DockerAPIError, e:
+            if e.status == 404:
+                return None
+            raise
+
+    def image_id(self, tag):
+        try:
+            return self.request("GET", "/images/%s/json" % (tag))['Id']
+        except DockerAPIError, e:
+            if e.status == 404:
+                return None
+            raise
+
+    def ps(self, names=None, size=False):
+        params = {'all' : 1, 'size' : int(size)}
+        if names is not None:
+            params['filters'] = json.dumps({'name' : list(docker_name_filter(n) for n in names)})
+        return self.request("GET", "/containers/json", params)
+
+    def build(self, dir, no_cache=False, tag=None):
+        context = tempfile.TemporaryFile()
+        tar = tarfile.open(fileobj=context, mode="w")
+        tar.add(dir, arcname=".", filter=dockerignore_filter(dir))
+        tar.close()
+        context.seek(0, os.SEEK_END)
+        length = context.tell()
+        context.seek(0)
+        params = {'rm' : 1}
+        if no_cache:
+            params['nocache'] = 1
+        if tag is not None:
+            params['t'] = tag
+        res = self.open("POST", "/build", params, context,
+            {'Content-Type' : 'application/x-tar', 'Content-Length' : str(length)})
+        for msg in self.read_stream(res):
+            if 'stream' in msg:
+                sys.stdout.write(msg['stream'])
+        context.close()
+
+    def save(self, tag, output):
+        res = self.open("GET", "/images/%s/get" % (tag))
+        with open(output, "wb") as handle:
+            while True:
+                chunk = res.read(1024 * 1024)
+                if not chunk:
+                    break
+                handle.write(chunk)
+
+    def load(self, write):
+        conn = self.new_connection()
+        conn.putrequest("POST", self.url("/images/load", {'quiet' : 1}))
+        conn.putheader("Content-Type", "application/x-tar")
+        conn.putheader("Transfer-Encoding", "chunked")
+        conn.endheaders()
+        write(ChunkedWriter(conn))
+        conn.send("0\r\n\r\n")
+        res = conn.getresponse()
+        if res.status >= 400:
+            raise DockerAPIError(res.status, self.error_message(res.read()))
+        for msg in self.read_stream(res):
+            logging.info(msg.get('stream', '').strip())
+
+
+def dockerignore_pattern(pattern):
+    """
+    Translate a .dockerignore pattern into a regex matching the path and
+    everything under it.
+    """
+    out = ""
+    i = 0
+    while i < len(pattern):
+        if pattern[i:i+3] == "**/":
+            out += "(.*/)?"
+            i += 3
+        elif pattern[i:i+2] == "**":
+            out += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            out += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            out += "[^/]"
+            i += 1
+        else:
+            out += re.escape(pattern[i])
+            i += 1
+    return re.compile("^%s(/.*)?$" % (out))
+
+
+def dockerignore_filter(dir):
+    """
+    Returns a tarfile filter dropping what the .dockerignore in dir
+    excludes, the way the docker CLI does when sending a build context.
+    The Dockerfile and .dockerignore are always sent.
+    """
+    path = os.path.join(dir, ".dockerignore")
+    if not os.path.exists(path):
+        return None
+    rules = []
+    with open(path) as handle:
+        for line in handle:
+            line = line.strip()
+            if not len(line) or line.startswith("#"):
+                continue
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:].strip()
+            line = os.path.normpath(line).lstrip("/")
+            rules.append( (dockerignore_pattern(line), negate, line) )
+    exceptions = list( line for pattern, negate, line in rules if negate )
+
+    def filter(info):
+        name = info.name[2:] if info.name.startswith("./") else info.name
+        if name in ["", ".", "Dockerfile", ".dockerignore"]:
+            return info
+        excluded = False
+        for pattern, negate, line in rules:
+            if pattern.match(name):
+                excluded = not negate
+        if not excluded:
+            return info
+        #keep walking an excluded directory if a '!' rule may match inside it
+        if info.isdir() and any( a.startswith(name + "/") or has_magic(a) for a in exceptions ):
+            return info
+        return None
+    return filter
+
+
+class ChunkedWriter(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def write(self, data):
+        if len(data):
+            self.conn.send("%x\r\n%s\r\n" % (len(data), data))
+
+
+def docker_state(status):
+    #older daemons only report the human readable status
+    if status.startswith("Up"):
+        return "running"
+    if status.startswith("Exited"):
+        return "exited"
+    return status.split(" ")[0].lower()
+
+
+def docker_container_record(c):
+    """
+    Normalise a container from the containers API into the form used by
+    run_status.
+    """
+    ports = []
+    for p in c.get('Ports', []) or []:
+        if 'PublicPort' in p:
+            ports.append("%s:%s->%s/%s" % (p.get('IP', '0.0.0.0'), p['PublicPort'], p['PrivatePort'], p['Type']))
+        else:
+            ports.append("%s/%s" % (p['PrivatePort'], p['Type']))
+    return {
+        'id' : c['Id'],
+        'name' : c.get('Names', ["/"])[0].lstrip("/"),
+        'image' : c.get('Image', None),
+        'state' : c.get('State', None) or docker_state(c.get('Status', '')),
+        'status' : c.get('Status', None),
+        'ports' : ports,
+        'created' : c.get('Created', None)
+    }
+
+
+def docker_cli_record(c):
+    """
+    Normalise a line of 'docker ps --format {{json .}}' into the form used
+    by run_status.
+    """
+    created = None
+    if c.get('CreatedAt', None):
+        #e.g. '2016-05-03 10:12:34 -0700 PDT'
+        fields = c['CreatedAt'].split()
+        created = calendar.timegm(time.strptime(" ".join(fields[:2]), "%Y-%m-%d %H:%M:%S"))
+        if len(fields) > 2 and re.match(r"^[+-]\d{4}$", fields[2]):
+            offset = int(fields[2][1:3]) * 3600 + int(fields[2][3:5]) * 60
+            created -= offset if fields[2][0] == "+" else -offset
+    return {
+        'id' : c['ID'],
+        'name' : c.get('Names', '').split(",")[0],
+        'image' : c.get('Image', None),
+        'state' : c.get('State', None) or docker_state(c.get('Status', '')),
+        'status' : c.get('Status', None),
+        'ports' : list( a.strip() for a in c.get('Ports', '').split(",") if len(a.strip()) ),
+        'created' : created
+    }
+
+
+DOCKER_CLIENTS = {}
+
+def docker_client(host=None, sudo=False):
+    """
+    Returns a DockerClient for host, or None if the docker CLI should be
+    used instead. WARPDRIVE_DOCKER=cli forces the CLI, as does sudo, a
+    TLS-secured DOCKER_HOST or one the client can't dial (ssh://, npipe://,
+    fd://); otherwise the API is used if the daemon answers.
+    """
+    mode = os.environ.get("WARPDRIVE_DOCKER", "auto")
+    if mode == "cli" or sudo or 'DOCKER_TLS_VERIFY' in os.environ:
+        return None
+    if host not in DOCKER_CLIENTS:
+        try:
+            client = DockerClient(host)
+        except ValueError, e:
+            #e.g. ssh:// or npipe:// hosts, which only the CLI knows how to reach
+            if mode == "api":
+                raise
+            logging.debug("%s, using docker CLI" % (e))
+            client = None
+        if client is not None and not client.ping():
+            if mode == "api":
+                raise Exception("Cannot reach docker daemon at %s" % (host))
+            logging.debug("Docker API not reachable, using docker CLI")
+            client = None
+        DOCKER_CLIENTS[host] = client
+    return DOCKER_CLIENTS[host]
 
 def call_docker_run(
     galaxy, ports={},
@@ -55,6 +706,12 @@ def call_docker_run(
     privledged=False,
     name=None):
 
+    client = docker_client(host, sudo)
+    if client is not None:
+        client.run(galaxy, ports=ports, args=args, env=env, set_user=set_user,
+            mounts=mounts, privledged=privledged, name=name)
+        return
+
     docker_path = get_docker_path()
 
     cmd = [
@@ -77,9 +734,7 @@ def call_docker_run(
     cmd.extend( [galaxy] )
     cmd.extend(args)
 
-    sys_env = dict(os.environ)
-    if host is not None:
-        sys_env['DOCKER_HOST'] = host
+    sys_env = docker_env(host)
     if sudo:
         cmd = ['sudo'] + cmd
     logging.info("executing: " + " ".join(cmd))
@@ -93,13 +748,16 @@ def call_docker_attach(
     host=None, sudo=False,
     name=None):
 
+    client = docker_client(host, sudo)
+    if client is not None:
+        client.attach(name)
+        return
+
     docker_path = get_docker_path()
     cmd = [
         docker_path, "attach", name
     ]
-    sys_env = dict(os.environ)
-    if host is not None:
-        sys_env['DOCKER_HOST'] = host
+    sys_env = docker_env(host)
     if sudo:
         cmd = ['sudo'] + cmd
     logging.info("executing: " + " ".join(cmd))
@@ -115,14 +773,18 @@ def call_docker_copy(
     host = None,
     sudo = False):
 
+    client = docker_client(host, sudo)
+    if client is not None:
+        name, path = src.split(":", 1)
+        client.copy(name, path, dst)
+        return
+
     docker_path = get_docker_path()
 
     cmd = [
         docker_path, "cp", src, dst
     ]
-    sys_env = dict(os.environ)
-    if host is not None:
-        sys_env['DOCKER_HOST'] = host
+    sys_env = docker_env(host)
     if sudo:
         cmd = ['sudo'] + cmd
     logging.info("executing: " + " ".join(cmd))
@@ -134,14 +796,17 @@ def call_docker_kill(
     host=None, sudo=False
     ):
 
+    client = docker_client(host, sudo)
+    if client is not None:
+        client.kill(name)
+        return
+
     docker_path = get_docker_path()
 
     cmd = [
         docker_path, "kill", name
     ]
-    sys_env = dict(os.environ)
-    if host is not None:
-        sys_env['DOCKER_HOST'] = host
+    sys_env = docker_env(host)
     if sudo:
         cmd = ['sudo'] + cmd
     logging.info("executing: " + " ".join(cmd))
@@ -152,6 +817,11 @@ def call_docker_rm(
     host=None, sudo=False
     ):
 
+    client = docker_client(host, sudo)
+    if client is not None:
+        client.rm(name, volume_delete=volume_delete)
+        return
+
     docker_path = get_docker_path()
 
     cmd = [
@@ -161,9 +831,7 @@ def call_docker_rm(
         cmd.append("-v")
     cmd.append(name)
 
-    sys_env = dict(os.environ)
-    if host is not None:
-        sys_env['DOCKER_HOST'] = host
+    sys_env = docker_env(host)
     if sudo:
         cmd = ['sudo'] + cmd
     logging.info("executing: " + " ".join(cmd))
@@ -174,19 +842,35 @@ def call_docker_rm(
 
 
 
+def docker_name_filter(name):
+    return "^/%s$" % (name.replace(".", "\\."))
+
+
 def call_docker_ps(
-    host=None, sudo=False
+    host=None, sudo=False,
+    names=None
     ):
+    """
+    List containers, all of them or only those called one of names, as
+    dicts with id, name, image, state, status, ports and created time.
+    Container sizes are not requested, as the daemon computes them by
+    walking every container's filesystem.
+    """
+
+    client = docker_client(host, sudo)
+    if client is not None:
+        return list( docker_container_record(c) for c in client.ps(names=names) )
 
     docker_path = get_docker_path()
 
     cmd = [
-        docker_path, "ps", "-a", "--no-trunc", "-s"
+        docker_path, "ps", "-a", "--no-trunc", "--format", "{{json .}}"
     ]
+    if names is not None:
+        for n in names:
+            cmd.extend( ["--filter", "name=%s" % (docker_name_filter(n))] )
 
-    sys_env = dict(os.environ)
-    if host is not None:
-        sys_env['DOCKER_HOST'] = host
+    sys_env = docker_env(host)
     if sudo:
         cmd = ['sudo'] + cmd
     logging.info("executing: " + " ".join(cmd))
@@ -194,7 +878,59 @@ def call_docker_ps(
     stdout, stderr = proc.communicate()
     if proc.returncode != 0:
         raise Exception("Call Failed: %s" % (cmd))
-    return stdout
+    return list( docker_cli_record(json.loads(line)) for line in stdout.split("\n") if len(line.strip()) )
+
+
+def call_docker_inspect(
+    name,
+    host=None, sudo=False
+    ):
+
+    client = docker_client(host, sudo)
+    if client is not None:
+        return client.inspect(name)
+
+    docker_path = get_docker_path()
+
+    cmd = [
+        docker_path, "inspect", name
+    ]
+
+    sys_env = docker_env(host)
+    if sudo:
+        cmd = ['sudo'] + cmd
+    logging.debug("executing: " + " ".join(cmd))
+    proc = subprocess.Popen(cmd, close_fds=True, env=sys_env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = proc.communicate()
+    if proc.returncode != 0:
+        return None
+    return json.loads(stdout)[0]
+
+
+def call_docker_image_id(
+    tag,
+    host=None, sudo=False
+    ):
+
+    client = docker_client(host, sudo)
+    if client is not None:
+        return client.image_id(tag)
+
+    docker_path = get_docker_path()
+
+    cmd = [
+        docker_path, "inspect", "--type", "image", "--format", "{{.Id}}", tag
+    ]
+
+    sys_env = docker_env(host)
+    if sudo:
+        cmd = ['sudo'] + cmd
+    logging.debug("executing: " + " ".join(cmd))
+    proc = subprocess.Popen(cmd, close_fds=True, env=sys_env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = proc.communicate()
+    if proc.returncode != 0:
+        return None
+    return stdout.strip()
 
 
 def call_docker_build(
@@ -205,6 +941,11 @@ def call_docker_build(
     tag=None
     ):
 
+    client = docker_client(host, sudo)
+    if client is not None:
+        client.build(dir, no_cache=no_cache, tag=tag)
+        return
+
     docker_path = get_docker_path()
 
     cmd = [
@@ -216,9 +957,7 @@ def call_docker_build(
         cmd.extend( ['-t', tag] )
     cmd.append(dir)
 
-    sys_env = dict(os.environ)
-    if host is not None:
-        sys_env['DOCKER_HOST'] = host
+    sys_env = docker_env(host)
     if sudo:
         cmd = ['sudo'] + cmd
     logging.info("executing: " + " ".join(cmd))
@@ -234,15 +973,17 @@ def call_docker_save(
     sudo=False,
     ):
 
+    client = docker_client(host, sudo)
+    if client is not None:
+        client.save(tag, output)
+        return
 
     docker_path = get_docker_path()
 
     cmd = [
         docker_path, "save", "-o", output, tag
     ]
-    sys_env = dict(os.environ)
-    if host is not None:
-        sys_env['DOCKER_HOST'] = host
+    sys_env = docker_env(host)
     if sudo:
         cmd = ['sudo'] + cmd
     logging.info("executing: " + " ".join(cmd))
@@ -251,281 +992,1463 @@ def call_docker_save(
     if proc.returncode != 0:
         raise Exception("Call Failed: %s" % (cmd))
 
-def scan_directory(lpath, metadata_suffix=None):
-    data_load = []
-    meta_data = {}
-    for a in glob(os.path.join(lpath, "*")):
-        if metadata_suffix is None or not a.endswith(metadata_suffix):
+
+def call_docker_load(
+    image_file,
+    host=None,
+    sudo=False
+    ):
+
+    client = docker_client(host, sudo)
+    if client is not None:
+        client.load(lambda handle: write_image(image_file, handle))
+        return
+
+    docker_path = get_docker_path()
+
+    cmd = [
+        docker_path, "load"
+    ]
+    sys_env = docker_env(host)
+    if sudo:
+        cmd = ['sudo'] + cmd
+    logging.info("executing: " + " ".join(cmd) + " < " + image_file)
+    proc = subprocess.Popen(cmd, close_fds=True, env=sys_env, stdin=subprocess.PIPE)
+    pipe = ProcessPipe(proc, proc.stdin, cmd)
+    try:
+        write_image(image_file, pipe)
+    finally:
+        pipe.close()
+
+
+"""
+Code for exporting and loading images
+"""
+
+IMAGE_EXTENSIONS = {
+    None : ".tar",
+    "gzip" : ".tar.gz",
+    "zstd" : ".tar.zst"
+}
+LAYERED_EXTENSION = ".layers.tar"
+LAYER_KEY = "WARPDRIVE.layer"
+LAYER_SIZE = "WARPDRIVE.size"
+
+class ProcessPipe(object):
+    """
+    File-like wrapper around one end of a subprocess pipe. close() waits for
+    the process and raises if it failed.
+    """
+
+    def __init__(self, proc, handle, cmd):
+        self.proc = proc
+        self.handle = handle
+        self.cmd = cmd
+
+    def read(self, size=-1):
+        return self.handle.read(size)
+
+    def write(self, data):
+        self.handle.write(data)
+
+    def close(self):
+        self.handle.close()
+        if self.proc.wait() != 0:
+            raise Exception("Call Failed: %s" % (self.cmd))
+
+
+def open_docker_save(tag, host=None, sudo=False):
+    client = docker_client(host, sudo)
+    if client is not None:
+        return client.open("GET", "/images/%s/get" % (tag))
+    cmd = [get_docker_path(), "save", tag]
+    if sudo:
+        cmd = ['sudo'] + cmd
+    logging.info("executing: " + " ".join(cmd))
+    proc = subprocess.Popen(cmd, close_fds=True, env=docker_env(host), stdout=subprocess.PIPE)
+    return ProcessPipe(proc, proc.stdout, cmd)
+
+
+def open_compressed(path, compress=None):
+    if compress is None:
+        return open(path, "wb")
+    if compress == "gzip":
+        return gzip.GzipFile(path, "wb", compresslevel=6)
+    if compress == "zstd":
+        if zstandard is not None:
+            return zstandard.ZstdCompressor().stream_writer(open(path, "wb"))
+        if which("zstd") is None:
+            raise Exception("zstd compression needs the zstandard module or the zstd binary")
+        cmd = ["zstd", "-q", "-c"]
+        proc = subprocess.Popen(cmd, close_fds=True, stdin=subprocess.PIPE, stdout=open(path, "wb"))
+        return ProcessPipe(proc, proc.stdin, cmd)
+    raise Exception("Unknown compression: %s" % (compress))
+
+
+def open_decompressed(path):
+    if path.endswith(".gz"):
+        return gzip.GzipFile(path, "rb")
+    if path.endswith(".zst"):
+        if zstandard is not None:
+            return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+        cmd = ["zstd", "-q", "-d", "-c", path]
+        proc = subprocess.Popen(cmd, close_fds=True, stdout=subprocess.PIPE)
+        return ProcessPipe(proc, proc.stdout, cmd)
+    return open(path, "rb")
+
+
+def image_file_name(tag, compress=None, layer_store=False):
+    name = "docker_" + tag.split(":")[0]
+    if layer_store:
+        return name + LAYERED_EXTENSION
+    return name + IMAGE_EXTENSIONS[compress]
+
+
+def image_archive_name(image_file):
+    """
+    The image name of an archive written by image_file_name, or None if the
+    file isn't one.
+    """
+    base = os.path.basename(image_file)
+    if not base.startswith("docker_"):
+        return None
+    base = base[len("docker_"):]
+    for ext in [LAYERED_EXTENSION] + sorted(IMAGE_EXTENSIONS.values(), key=len, reverse=True):
+        if base.endswith(ext):
+            return base[:-len(ext)]
+    return None
+
+
+def image_layer_key(member):
+    #legacy 'docker save' archives keep layers in <id>/layer.tar, OCI ones in
+    #blobs/sha256/<digest>; both names are content derived
+    if not member.isfile():
+        return None
+    if member.name.endswith("/layer.tar"):
+        return member.name[:-len("/layer.tar")].replace("/", "_")
+    if member.name.startswith("blobs/"):
+        return member.name.replace("/", "_")
+    return None
+
+
+def export_image(tag, output, compress=None, layer_dir=None, host=None, sudo=False):
+    """
+    Stream 'docker save' of tag into output, compressed with gzip or zstd.
+    With a layer_dir, layers are stored there once, compressed and keyed by
+    their name in the archive, and output only holds the remaining image
+    metadata with a reference to each layer.
+    """
+    stream = open_docker_save(tag, host=host, sudo=sudo)
+    tmp = output + ".tmp"
+    try:
+        if layer_dir is None:
+            out = open_compressed(tmp, compress)
+            shutil.copyfileobj(stream, out, 1024 * 1024)
+            out.close()
+        else:
+            if not os.path.exists(layer_dir):
+                os.mkdir(layer_dir)
+            src = tarfile.open(fileobj=stream, mode="r|")
+            dst = tarfile.open(tmp, mode="w", format=tarfile.PAX_FORMAT)
+            for member in src:
+                key = image_layer_key(member)
+                if key is not None:
+                    layer_name = key + IMAGE_EXTENSIONS[compress]
+                    layer_file = os.path.join(layer_dir, layer_name)
+                    if os.path.exists(layer_file):
+                        logging.debug("Layer %s already stored" % (key))
+                    else:
+                        layer_tmp = "%s.tmp%d" % (layer_file, os.getpid())
+                        out = open_compressed(layer_tmp, compress)
+                        shutil.copyfileobj(src.extractfile(member), out, 1024 * 1024)
+                        out.close()
+                        os.rename(layer_tmp, layer_file)
+                    stub = copy.copy(member)
+                    stub.pax_headers = dict( (k, v) for k, v in member.pax_headers.items() if k != "size" )
+                    stub.pax_headers[LAYER_KEY] = layer_name
+                    stub.pax_headers[LAYER_SIZE] = str(member.size)
+                    stub.size = 0
+                    dst.addfile(stub)
+                elif member.isfile():
+                    dst.addfile(member, src.extractfile(member))
+                else:
+                    dst.addfile(member)
+            dst.close()
+            src.close()
+        stream.close()
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    os.rename(tmp, output)
+
+
+def image_layer_files(image_file):
+    """
+    Paths in the layer store of the layers referenced by a layered image
+    archive.
+    """
+    layer_dir = os.path.join(os.path.dirname(image_file), "layers")
+    out = []
+    with tarfile.open(image_file) as src:
+        for member in src:
+            if LAYER_KEY in member.pax_headers:
+                out.append(os.path.join(layer_dir, member.pax_headers[LAYER_KEY]))
+    return out
+
+
+def write_image(image_file, handle):
+    """
+    Write the 'docker load'-able archive stored in image_file to handle,
+    decompressing it or reassembling it from the layer store as needed.
+    """
+    if image_file.endswith(LAYERED_EXTENSION):
+        layer_dir = os.path.join(os.path.dirname(image_file), "layers")
+        src = tarfile.open(image_file)
+        dst = tarfile.open(fileobj=handle, mode="w|", format=tarfile.PAX_FORMAT)
+        for member in src:
+            if LAYER_KEY in member.pax_headers:
+                layer = open_decompressed(os.path.join(layer_dir, member.pax_headers.pop(LAYER_KEY)))
+                member.size = int(member.pax_headers.pop(LAYER_SIZE))
+                dst.addfile(member, layer)
+                layer.close()
+            elif member.isfile():
+                dst.addfile(member, src.extractfile(member))
+            else:
+                dst.addfile(member)
+        dst.close()
+        src.close()
+    else:
+        src = open_decompressed(image_file)
+        shutil.copyfileobj(src, handle, 1024 * 1024)
+        src.close()
+
+
+def image_archives(image_dir):
+    """
+    Returns {image name : archive} for the image archives in image_dir. If
+    an image was saved in more than one form, the newest archive is used.
+    """
+    out = {}
+    for image_file in glob(os.path.join(image_dir, "docker_*.tar*")):
+        name = image_archive_name(image_file)
+        if name is None:
+            continue
+        if name not in out or os.path.getmtime(image_file) > os.path.getmtime(out[name]):
+            out[name] = image_file
+    return out
+
+
+TOOL_IMAGES_LOCK = threading.Lock()
+
+def expand_tool_images(image_dir):
+    """
+    Galaxy's image cache only loads plain docker_<name>.tar archives, so
+    write one next to every compressed or layered archive in image_dir that
+    doesn't already have a current one. This costs the disk space the
+    compression or layer store saved.
+    """
+    #fleet members start concurrently; the first expands, the rest find it current
+    with TOOL_IMAGES_LOCK:
+        for name, image_file in sorted(image_archives(image_dir).items()):
+            expand_tool_image(image_dir, name, image_file)
+
+
+def expand_tool_image(image_dir, name, image_file):
+    plain = os.path.join(image_dir, image_file_name(name))
+    if image_file == plain:
+        return
+    start = time.time()
+    fd, tmp = tempfile.mkstemp(dir=image_dir, prefix=os.path.basename(plain) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as handle:
+            write_image(image_file, handle)
+        os.rename(tmp, plain)
+    except:
+        os.unlink(tmp)
+        raise
+    logging.info("Expanded %s to %s in %.1fs" % (image_file, plain, time.time() - start))
+
+
+def run_load(image_dir, host=None, sudo=False, tool=None):
+    for name, image_file in sorted(image_archives(image_dir).items()):
+        if tool is not None and name not in list(a.split(":")[0] for a in tool):
+            continue
+        start = time.time()
+        call_docker_load(image_file, host=host, sudo=sudo)
+        print "%s\tload: %.1fs" % (name, time.time() - start)
+
+
+def list_directory(path):
+    """
+    Returns the files and subdirectories of path. With scandir the entry
+    types come from the directory listing itself, so no stat is needed.
+    Hidden entries (.git, .DS_Store, ...) are skipped, as glob("*") does.
+    """
+    files = []
+    dirs = []
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.name.startswith("."):
+                continue
+            if entry.is_file():
+                files.append(entry.path)
+            elif entry.is_dir():
+                dirs.append(entry.path)
+    else:
+        for n in os.listdir(path):
+            if n.startswith("."):
+                continue
+            a = os.path.join(path, n)
             if os.path.isfile(a):
-                data_load.append( a )
+                files.append(a)
             elif os.path.isdir(a):
-                d, m = scan_directory(a, metadata_suffix)
-                for i in d:
-                    data_load.append(i)
-                for k,v in m.items():
-                    meta_data[k] = v
-        elif metadata_suffix is not None:
-            file = a[:-len(metadata_suffix)]
-            if os.path.exists(file):
-                try:
-                    with open(a) as handle:
-                        txt = handle.read()
-                        md = json.loads(txt)
-                        meta_data[ os.path.join(dpath, os.path.relpath(file, lpath) ) ] = md
-                        logging.debug("Found metadata for %s " % (file))
-                except:
-                    pass
+                dirs.append(a)
+    files.sort()
+    dirs.sort()
+    return files, dirs
+
+
+def load_metadata(path):
+    try:
+        with open(path) as handle:
+            return json.loads(handle.read())
+    except (IOError, ValueError), e:
+        logging.warning("Unable to load metadata %s: %s" % (path, e))
+    return {}
+
+
+class MetadataIndex(object):
+    """
+    Dataset metadata read once from a single manifest file, in place of one
+    sidecar file per dataset. The manifest is either JSON lines, one object
+    per file with a 'path' field, or a TSV file (.tsv) with a header row that
+    has a 'path' column; all other fields are the metadata. Paths may be
+    absolute, or relative to any of the roots (the lib_data directories).
+    """
+
+    def __init__(self, path, roots=[]):
+        self.path = os.path.abspath(path)
+        self.roots = list(os.path.abspath(a) for a in roots)
+        self.entries = {}
+        name = path[:-3] if path.endswith(".gz") else path
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path) as handle:
+            if name.endswith(".tsv"):
+                reader = csv.DictReader(handle, delimiter="\t")
+                if reader.fieldnames is None or 'path' not in reader.fieldnames:
+                    raise Exception("Metadata manifest %s has no 'path' column" % (path))
+                for rec in reader:
+                    self.add(dict( (k, v) for k, v in rec.items() if v is not None and len(v) ))
+            else:
+                for i, line in enumerate(handle):
+                    if not len(line.strip()):
+                        continue
+                    try:
+                        rec = json.loads(line)
+                    except ValueError, e:
+                        raise Exception("Invalid metadata manifest %s line %d: %s" % (path, i + 1, e))
+                    if not isinstance(rec, dict) or 'path' not in rec:
+                        raise Exception("Metadata manifest %s line %d has no 'path'" % (path, i + 1))
+                    self.add(rec)
+        logging.info("Loaded metadata for %d files from %s" % (len(self.entries), path))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, rec):
+        path = os.path.normpath(rec.pop('path'))
+        self.entries[path] = rec
+
+    def get(self, path):
+        path = os.path.abspath(path)
+        md = self.entries.get(path, None)
+        if md is None:
+            for root in self.roots:
+                if path.startswith(root + os.sep):
+                    md = self.entries.get(path[len(root)+1:], None)
+                    if md is not None:
+                        break
+        if md is None:
+            return {}
+        return dict(md)
+
+
+def scan_directory_entries(files, metadata_suffix=None):
+    """
+    Pair every data file in files with its sidecar metadata file, or None.
+    Sidecars are found in the listing itself, so nothing is stat'ed.
+    """
+    if metadata_suffix is None:
+        for a in files:
+            yield a, None
+        return
+    names = set(files)
+    for a in files:
+        if not a.endswith(metadata_suffix):
+            if a + metadata_suffix in names:
+                yield a, a + metadata_suffix
+            else:
+                yield a, None
+
+
+def walk_directory(lpath, metadata_suffix=None, workers=1):
+    """
+    Walk lpath, yielding (path, sidecar) for every data file as soon as its
+    directory has been listed. With workers > 1 subtrees are listed on a pool
+    of threads and files are yielded in no particular order.
+    """
+    if workers <= 1:
+        stack = [lpath]
+        while len(stack):
+            path = stack.pop()
+            try:
+                files, dirs = list_directory(path)
+            except OSError, e:
+                logging.warning("Unable to scan %s: %s" % (path, e))
+                continue
+            for out in scan_directory_entries(files, metadata_suffix):
+                yield out
+            stack.extend(reversed(dirs))
+        return
+
+    dir_queue = Queue.Queue()
+    out_queue = Queue.Queue(maxsize=workers * 16)
+    lock = threading.Lock()
+    stop = threading.Event()
+    state = {'pending' : 1}
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def worker():
+        while not stop.is_set():
+            path = dir_queue.get()
+            if path is None:
+                break
+            try:
+                files, dirs = list_directory(path)
+                put(list(scan_directory_entries(files, metadata_suffix)))
+            except OSError, e:
+                logging.warning("Unable to scan %s: %s" % (path, e))
+                dirs = []
+            with lock:
+                state['pending'] += len(dirs) - 1
+                done = state['pending'] == 0
+            for d in dirs:
+                dir_queue.put(d)
+            if done:
+                put(None)
+
+    threads = []
+    for i in range(workers):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    dir_queue.put(lpath)
+
+    try:
+        while True:
+            entries = out_queue.get()
+            if entries is None:
+                break
+            for out in entries:
+                yield out
+    finally:
+        stop.set()
+        for t in threads:
+            dir_queue.put(None)
+
+
+def load_sidecars(entries, workers=1, read_ahead=256):
+    """
+    Turn (path, sidecar) pairs into (path, metadata) pairs. Sidecars are only
+    read as the consumer pulls entries; with workers > 1 the reads run on a
+    pool of threads, at most read_ahead entries ahead, and pairs still come
+    out in the order they went in.
+    """
+    if workers <= 1:
+        for path, sidecar in entries:
+            if sidecar is not None:
+                logging.debug("Found metadata for %s " % (path))
+                yield path, load_metadata(sidecar)
+            else:
+                yield path, {}
+        return
+
+    work = Queue.Queue()
+    window = collections.deque()
+
+    def worker():
+        while True:
+            item = work.get()
+            if item is None:
+                break
+            slot, sidecar = item
+            slot[0] = load_metadata(sidecar)
+            slot[1].set()
+
+    def result(path, slot):
+        if slot[1] is not None:
+            slot[1].wait()
+        return path, slot[0]
+
+    threads = []
+    for i in range(workers):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    try:
+        for path, sidecar in entries:
+            if sidecar is None:
+                slot = [{}, None]
+            else:
+                slot = [None, threading.Event()]
+                work.put((slot, sidecar))
+            window.append((path, slot))
+            if len(window) >= read_ahead:
+                yield result(*window.popleft())
+        while len(window):
+            yield result(*window.popleft())
+    finally:
+        for t in threads:
+            work.put(None)
+
+
+def iter_directory(lpath, metadata_suffix=None, workers=1, metadata_workers=1, metadata_index=None):
+    """
+    Walk lpath, yielding (path, metadata) for every data file. Sidecar files
+    ending in metadata_suffix are read by load_sidecars, and entries from a
+    MetadataIndex are merged over them.
+    """
+    entries = walk_directory(lpath, metadata_suffix, workers=workers)
+    for path, md in load_sidecars(entries, workers=metadata_workers):
+        if metadata_index is not None:
+            md.update(metadata_index.get(path))
+        yield path, md
+
+
+def scan_directory(lpath, metadata_suffix=None, workers=1, metadata_workers=1, metadata_index=None):
+    data_load = []
+    meta_data = {}
+    for a, md in iter_directory(lpath, metadata_suffix, workers=workers,
+        metadata_workers=metadata_workers, metadata_index=metadata_index):
+        data_load.append(a)
+        if len(md):
+            meta_data[a] = md
     return data_load, meta_data
 
 
+def run_pool(func, items, workers=4):
+    """
+    Call func on every item from a pool of worker threads. Returns a list of
+    (item, result, exception) tuples in the order of items.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    work = Queue.Queue()
+    for i, item in enumerate(items):
+        work.put((i, item))
+
+    def worker():
+        while True:
+            try:
+                i, item = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = (item, func(item), None)
+            except Exception, e:
+                logging.error("%s failed: %s" % (item, e))
+                results[i] = (item, None, e)
+
+    threads = []
+    for i in range(max(1, min(workers, len(items)))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    return results
+
+
+class RateLimiter(object):
+    """
+    Spaces out calls to wait() so that, across all threads, no more than
+    rate of them return per second.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_time = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            wait_until = max(self.next_time, now)
+            self.next_time = wait_until + self.interval
+        if wait_until > now:
+            time.sleep(wait_until - now)
+
+
+def chunk_iter(items, size):
+    batch = []
+    for i in items:
+        batch.append(i)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if len(batch):
+        yield batch
+
+
+class IngestManifest(object):
+    """
+    Index of the files already pasted into an instance, kept as an append-only
+    JSON lines file in the instance config dir. Each record holds the host
+    path, size, mtime, Galaxy dataset id and uuid of a pasted file, and the
+    library it was pasted into. Records for any other library than
+    library_id, e.g. from an earlier container, are dropped on load.
+    """
+
+    def __init__(self, path, library_id=None):
+        self.path = path
+        self.library_id = library_id
+        self.entries = {}
+        self.lines = 0
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            stale = 0
+            malformed = 0
+            with open(path) as handle:
+                for line in handle:
+                    if len(line.strip()):
+                        self.lines += 1
+                        try:
+                            rec = json.loads(line)
+                            rec['path']
+                        except (ValueError, KeyError, TypeError):
+                            #e.g. a record torn by an interrupted write
+                            malformed += 1
+                            continue
+                        if library_id is not None and rec.get('library_id', None) != library_id:
+                            stale += 1
+                            continue
+                        self.entries[rec['path']] = rec
+            if stale:
+                logging.info("Ignoring %d manifest entries from another library" % (stale))
+            if malformed:
+                logging.warning("Skipping %d malformed entries in %s" % (malformed, path))
+                #rewrite now, so new records aren't appended to a torn line
+                self.compact()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def changed(self, path, st):
+        rec = self.entries.get(path, None)
+        if rec is None:
+            return True
+        return rec['size'] != st.st_size or rec['mtime'] != st.st_mtime
+
+    def record(self, records):
+        with self.lock:
+            with open(self.path, "a") as handle:
+                for rec in records:
+                    if self.library_id is not None:
+                        rec['library_id'] = self.library_id
+                    handle.write(json.dumps(rec) + "\n")
+                    self.entries[rec['path']] = rec
+                    self.lines += 1
+
+    def compact(self):
+        with self.lock:
+            if self.lines <= len(self.entries):
+                return
+            write_atomic(self.path, "".join( json.dumps(rec) + "\n" for rec in self.entries.values() ))
+            self.lines = len(self.entries)
+
+
+def ingest_files(rg, library_id, folder_id, data_load,
+    batch_size=100, workers=4, retries=3, report_interval=10, manifest=None):
+    """
+    Paste the (path, metadata) pairs of data_load into a library folder.
+    data_load may be a generator, batches are posted while it is consumed.
+    Paths are grouped into multi-path 'filesystem_paths' requests that are
+    posted by a pool of worker threads. Files that carry a uuid are pasted on
+    their own, as the uuid is set per request. If an IngestManifest is given,
+    files whose size and mtime match the manifest are skipped and pasted
+    files are recorded in it. Returns the number of files pasted and the list
+    of failed files.
+    """
+    work = Queue.Queue(maxsize=workers * 2)
+    lock = threading.Lock()
+    start = time.time()
+    state = {'pasted' : 0, 'skipped' : 0, 'failed' : [], 'reported' : start}
+
+    def paste(batch):
+        for attempt in range(retries + 1):
+            try:
+                if len(batch) == 1:
+                    path, md, st = batch[0]
+                    return [rg.library_paste_file(library_id, folder_id, os.path.basename(path), path, uuid=md.get('uuid', None))]
+                else:
+                    return rg.library_paste_files(library_id, folder_id, list(path for path, md, st in batch))
+            except Exception, e:
+                logging.warning("Paste of %d files failed (attempt %d): %s" % (len(batch), attempt + 1, e))
+                TRACE.count("paste_errors")
+                if attempt < retries:
+                    time.sleep(min(2 ** attempt, 30))
+        return None
+
+    def record(batch, datasets):
+        datasets = list( d for d in datasets if isinstance(d, dict) )
+        if len(datasets) != len(batch):
+            by_name = dict( (os.path.basename(d.get('name', None) or ""), d) for d in datasets )
+            datasets = list( by_name.get(os.path.basename(path), {}) for path, md, st in batch )
+        records = []
+        for (path, md, st), ds in zip(batch, datasets):
+            records.append({
+                'path' : path,
+                'size' : st.st_size,
+                'mtime' : st.st_mtime,
+                'id' : ds.get('id', None),
+                'uuid' : md.get('uuid', None)
+            })
+        manifest.record(records)
+
+    def process(batch):
+        with TRACE.span("paste", files=len(batch)):
+            datasets = paste(batch)
+        if not isinstance(datasets, list):
+            datasets = None
+        TRACE.count("files_pasted" if datasets is not None else "files_failed", len(batch))
+        if datasets is not None and manifest is not None:
+            try:
+                record(batch, datasets)
+            except Exception, e:
+                logging.error("Unable to record %d pasted files in the manifest: %s" % (len(batch), e))
+        return datasets
+
+    def worker():
+        while True:
+            batch = work.get()
+            if batch is None:
+                break
+            #a bad batch must never take the worker down, or the producer blocks
+            try:
+                datasets = process(batch)
+            except Exception, e:
+                logging.error("Paste of %d files failed: %s" % (len(batch), e))
+                datasets = None
+            with lock:
+                if datasets is not None:
+                    state['pasted'] += len(batch)
+                else:
+                    state['failed'].extend(path for path, md, st in batch)
+                now = time.time()
+                if now - state['reported'] >= report_interval:
+                    state['reported'] = now
+                    logging.info("Ingested %d files (%.1f files/sec)" % (state['pasted'], state['pasted'] / (now - start)))
+
+    threads = []
+    for i in range(max(workers, 1)):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    try:
+        pending = []
+        for path, md in data_load:
+            st = None
+            if manifest is not None:
+                try:
+                    st = os.stat(path)
+                except OSError, e:
+                    logging.warning("Skipping %s: %s" % (path, e))
+                    with lock:
+                        state['failed'].append(path)
+                    continue
+                if not manifest.changed(path, st):
+                    state['skipped'] += 1
+                    TRACE.count("files_unchanged")
+                    continue
+            if md.get('uuid', None) is not None:
+                work.put([(path, md, st)])
+            else:
+                pending.append((path, md, st))
+                if len(pending) >= batch_size:
+                    work.put(pending)
+                    pending = []
+        if len(pending):
+            work.put(pending)
+    finally:
+        for t in threads:
+            work.put(None)
+        for t in threads:
+            t.join()
+
+    elapsed = max(time.time() - start, 1e-6)
+    logging.info("Ingest complete: %d files in %.1f sec (%.1f files/sec), %d unchanged, %d failed" % (
+        state['pasted'], elapsed, state['pasted'] / elapsed, state['skipped'], len(state['failed'])))
+    for path in state['failed']:
+        logging.error("Failed to ingest: %s" % (path))
+    return state['pasted'], state['failed']
+
+
+def wait_for_galaxy(url, timeout=60, name=None, host=None, sudo=False,
+    interval=0.25, max_interval=2.0, check_interval=2.0):
+    """
+    Poll Galaxy's /api/version until it answers, starting at sub-second
+    intervals and backing off to max_interval. If the container name is
+    given its state is checked every check_interval seconds, so a container
+    that has already exited fails fast instead of running out the timeout.
+    Returns the number of seconds it took for Galaxy to become ready.
+    """
+    probe = RemoteGalaxy(url, None, pool_size=1, retries=0)
+    start = time.time()
+    last_check = start
+    delay = interval
+    while True:
+        if probe.ping(timeout=max(delay, 1.0)):
+            ready = time.time() - start
+            logging.info("Galaxy ready after %.2f sec" % (ready))
+            return ready
+        now = time.time()
+        if name is not None and now - last_check >= check_interval:
+            last_check = now
+            info = call_docker_inspect(name, host=host, sudo=sudo)
+            if info is None:
+                raise RequestException("Container %s not found" % (name))
+            if not info['State'].get('Running', False):
+                raise RequestException("Container %s exited with code %s" % (name, info['State'].get('ExitCode')))
+        if now - start > timeout:
+            raise Exception("Startup Timed out")
+        time.sleep(delay)
+        delay = min(delay * 2, max_interval)
+
+
 def run_up(name="galaxy", galaxy="bgruening/galaxy-stable", port=8080, host=None,
     sudo=False, lib_data=[], auto_add=False, tool_data=None, metadata_suffix=None,
     tool_dir=None, config_dir=DEFAULT_CONFIG, work_dir=None, tool_docker=False, force=False,
     tool_images=None, smp=[], cpus=None, timeout=60,
+    ingest_batch=100, ingest_workers=4, scan_workers=1,
+    metadata_manifest=None, metadata_workers=1, profile=None, metrics=None,
     hold=False, key="HSNiugRFvgT574F43jZ7N9F3"):
 
     if config_dir is None:
         config_dir = DEFAULT_CONFIG
 
-    if force and run_status(name=name,host=host, sudo=sudo):
-        run_down(name=name, host=host, rm=True, config_dir=config_dir, sudo=sudo)
-
-    env = {
-        "GALAXY_CONFIG_CHECK_MIGRATE_TOOLS" : "False",
-        "GALAXY_CONFIG_MASTER_API_KEY" : key,
-        "GALAXY_CONFIG_CLEANUP_JOB" : "onsuccess"
-    }
-
-    mounts = {}
-    privledged = False
-
-    if tool_data is not None:
-        mounts[os.path.abspath(tool_data)] = "/tool_data"
-        env['GALAXY_CONFIG_TOOL_DATA_PATH'] = "/tool_data"
-
-    if work_dir is not None:
-        if not os.path.exists(work_dir):
-            os.mkdir(work_dir)
-            os.chmod(work_dir, 0777)
-        files_path = os.path.join(os.path.abspath(work_dir), "files")
-        job_working_dir = os.path.join(os.path.abspath(work_dir), "job_working_directory")
-        if not os.path.exists(files_path):
-            os.mkdir(files_path)
-            os.chmod(files_path, 0777)
-        if not os.path.exists(job_working_dir):
-            os.mkdir(job_working_dir)
-            os.chmod(job_working_dir, 0777)
-        env['GALAXY_CONFIG_FILE_PATH'] = "/parent/database_files"
-        mounts[files_path] = "/parent/database_files"
-        env['GALAXY_CONFIG_JOB_WORKING_DIRECTORY'] = "/parent/job_working_directory"
-        mounts[job_working_dir] = "/parent/job_working_directory"
-
-    config_dir = os.path.abspath(os.path.join(config_dir, "warpdrive_%s" % (name)))
-    if not os.path.exists(config_dir):
-        os.mkdir(config_dir)
-
-    if tool_dir is not None:
-        mounts[os.path.abspath(tool_dir)] = "/tools_import"
-        mounts[config_dir] = "/config"
-        with open( os.path.join(config_dir, "import_tool_conf.xml"), "w" ) as handle:
-            handle.write(TOOL_IMPORT_CONF)
-        env['GALAXY_CONFIG_TOOL_CONFIG_FILE'] = "/config/import_tool_conf.xml,config/tool_conf.xml.main"
-
-    if tool_images is not None:
-        mounts[os.path.abspath(tool_images)] = "/images"
+    with profile_trace(profile, os.path.abspath(os.path.join(config_dir, "warpdrive_%s" % (name))), "up",
+        name=name, galaxy=galaxy):
+        if force and run_status(name=name, host=host, sudo=sudo, ready=False)['state'] != 'NotFound':
+            with TRACE.span("force_down"):
+                run_down(name=name, host=host, rm=True, config_dir=config_dir, sudo=sudo)
+
+        env = {
+            "GALAXY_CONFIG_CHECK_MIGRATE_TOOLS" : "False",
+            "GALAXY_CONFIG_MASTER_API_KEY" : key,
+            "GALAXY_CONFIG_CLEANUP_JOB" : "onsuccess"
+        }
+
+        mounts = {}
+        privledged = False
+
+        if tool_data is not None:
+            mounts[os.path.abspath(tool_data)] = "/tool_data"
+            env['GALAXY_CONFIG_TOOL_DATA_PATH'] = "/tool_data"
+
+        if work_dir is not None:
+            if not os.path.exists(work_dir):
+                os.mkdir(work_dir)
+                os.chmod(work_dir, 0777)
+            files_path = os.path.join(os.path.abspath(work_dir), "files")
+            job_working_dir = os.path.join(os.path.abspath(work_dir), "job_working_directory")
+            if not os.path.exists(files_path):
+                os.mkdir(files_path)
+                os.chmod(files_path, 0777)
+            if not os.path.exists(job_working_dir):
+                os.mkdir(job_working_dir)
+                os.chmod(job_working_dir, 0777)
+            env['GALAXY_CONFIG_FILE_PATH'] = "/parent/database_files"
+            mounts[files_path] = "/parent/database_files"
+            env['GALAXY_CONFIG_JOB_WORKING_DIRECTORY'] = "/parent/job_working_directory"
+            mounts[job_working_dir] = "/parent/job_working_directory"
+
+        config_dir = os.path.abspath(os.path.join(config_dir, "warpdrive_%s" % (name)))
+        if not os.path.exists(config_dir):
+            os.mkdir(config_dir)
+
+        if tool_dir is not None:
+            mounts[os.path.abspath(tool_dir)] = "/tools_import"
+            mounts[config_dir] = "/config"
+            with open( os.path.join(config_dir, "import_tool_conf.xml"), "w" ) as handle:
+                handle.write(TOOL_IMPORT_CONF)
+            env['GALAXY_CONFIG_TOOL_CONFIG_FILE'] = "/config/import_tool_conf.xml,config/tool_conf.xml.main"
+
+        if tool_images is not None:
+            with TRACE.span("expand_tool_images"):
+                expand_tool_images(tool_images)
+            mounts[os.path.abspath(tool_images)] = "/images"
+
+
+        lib_mapping = {}
+        for i, ld in enumerate(lib_data):
+            env['GALAXY_CONFIG_ALLOW_LIBRARY_PATH_PASTE'] = "True"
+            lpath = os.path.abspath(ld)
+            dpath = "/parent/lib_data_%s" % (i)
+            mounts[lpath] = dpath
+            lib_mapping[lpath] = dpath
+
+        if tool_docker:
+            common_volumes = ",".join( "%s:%s:ro" % (k,v) for k,v in lib_mapping.items() )
+
+            #tools with resource requirements or --smp counts get a destination
+            #for every different (cores, memory) combination
+            resources = tool_resources(tool_dir, smp, cpus)
+            smp_destinations = []
+            for cores, ram in sorted(set(resources.values())):
+                dest_name, native, params = resource_destination(cores, ram)
+                smp_destinations.append( string.Template(SMP_DEST_CONF).substitute(
+                    DEST_NAME=dest_name,
+                    TAG=galaxy,
+                    NAME=name,
+                    NATIVE_SPECIFICATION=native,
+                    RESOURCE_PARAMS=params,
+                    COMMON_VOLUMES=common_volumes)
+                )
 
+            smp_tools = []
+            for tool, (cores, ram) in sorted(resources.items()):
+                smp_tools.append( string.Template(SMP_TOOL_CONF).substitute(
+                        DEST_NAME=resource_destination(cores, ram)[0],
+                        TOOL_ID=tool
+                    )
+                )
 
-    data_load = []
-    meta_data = {}
-    lib_mapping = {}
-    for i, ld in enumerate(lib_data):
-        env['GALAXY_CONFIG_ALLOW_LIBRARY_PATH_PASTE'] = "True"
-        lpath = os.path.abspath(ld)
-        dpath = "/parent/lib_data_%s" % (i)
-        mounts[lpath] = dpath
-        lib_mapping[lpath] = dpath
-        if auto_add:
-            d, m = scan_directory(lpath, metadata_suffix)
-            for i in d:
-                data_load.append(i)
-            for k,v in m:
-                meta_data[k] = v
-
-    if tool_docker:
-        common_volumes = ",".join( "%s:%s:ro" % (k,v) for k,v in lib_mapping.items() )
-
-        #for every different count of SMPs, create a different destination
-        smp_destinations = []
-        for count in set( a[1] for a in smp ):
-            smp_destinations.append( string.Template(SMP_DEST_CONF).substitute(
-                DEST_NAME="docker_cluster_smp%s" % (count),
+            mounts[config_dir] = "/config"
+            job_conf = string.Template(JOB_CHILD_CONF).substitute(
                 TAG=galaxy,
                 NAME=name,
-                NCPUS=count,
-                COMMON_VOLUMES=common_volumes)
+                COMMON_VOLUMES=common_volumes,
+                SMP_DESTINATIONS="\n".join(smp_destinations),
+                SMP_TOOLS="\n".join(smp_tools)
+            )
+            with open( os.path.join(config_dir, "job_conf.xml"), "w" ) as handle:
+                handle.write(job_conf)
+            env["GALAXY_CONFIG_JOB_CONFIG_FILE"] = "/config/job_conf.xml"
+            #env['GALAXY_CONFIG_OUTPUTS_TO_WORKING_DIRECTORY'] = "True"
+            env['DOCKER_PARENT'] = "True"
+            privledged=True
+            mounts['/var/run/docker.sock'] = '/var/run/docker.sock'
+
+        if cpus is not None:
+            env['SLURM_CPUS'] = cpus
+
+        with TRACE.span("docker_run"):
+            call_docker_run(
+                galaxy,
+                ports={str(port) : "80"},
+                host=host,
+                sudo=sudo,
+                name=name,
+                mounts=mounts,
+                privledged=privledged,
+                env=env
             )
 
-        smp_tools = []
-        for tool, count in smp:
-            smp_tools.append( string.Template(SMP_TOOL_CONF).substitute(
-                    DEST_NAME="docker_cluster_smp%s" % (count),
-                    TOOL_ID=tool
-                )
+        web_host="localhost"
+        if 'DOCKER_HOST' in os.environ:
+            u = urlparse.urlparse(os.environ['DOCKER_HOST'])
+            web_host = u.netloc.split(":")[0]
+
+        with TRACE.span("wait_for_galaxy"):
+            ready_seconds = wait_for_galaxy("http://%s:%s" % (web_host, port), timeout=timeout,
+                name=name, host=host, sudo=sudo)
+
+        rg = RemoteGalaxy("http://%s:%s"  % (web_host, port), 'admin', path_mapping=lib_mapping,
+            pool_size=max(10, ingest_workers))
+        with TRACE.span("create_library"):
+            library_id = rg.create_library("Imported")
+            folder_id = rg.library_find_contents(library_id, "/")['id']
+        if metadata_manifest is not None:
+            metadata_manifest = os.path.abspath(metadata_manifest)
+        failed = []
+        if auto_add:
+            metadata_index = None
+            if metadata_manifest is not None:
+                with TRACE.span("load_metadata_manifest"):
+                    metadata_index = MetadataIndex(metadata_manifest, lib_mapping.keys())
+            data_load = TRACE.timed_iter("scan", itertools.chain.from_iterable(
+                iter_directory(lpath, metadata_suffix, workers=scan_workers,
+                    metadata_workers=metadata_workers, metadata_index=metadata_index) for lpath in lib_mapping
+            ))
+            manifest = IngestManifest(os.path.join(config_dir, "ingest_manifest.jsonl"), library_id)
+            with TRACE.span("ingest"):
+                pasted, failed = ingest_files(rg, library_id, folder_id, data_load,
+                    batch_size=ingest_batch, workers=ingest_workers, manifest=manifest)
+                manifest.compact()
+
+        with open(os.path.join(config_dir, "config.json"), "w") as handle:
+            handle.write(json.dumps({
+                'galaxy' : galaxy,
+                'port' : port,
+                'lib_data' : list(os.path.abspath(a) for a in lib_data),
+                'host' : web_host,
+                'tool_dir' : os.path.abspath(tool_dir) if tool_dir is not None else None,
+                'tool_data' : os.path.abspath(tool_data) if tool_data is not None else None,
+                'metadata_suffix' : metadata_suffix,
+                'metadata_manifest' : metadata_manifest,
+                'tool_docker' : tool_docker,
+                'key' : key,
+                'lib_mapping' : lib_mapping,
+                'library_id' : library_id,
+                'folder_id' : folder_id,
+                'ready_seconds' : ready_seconds
+            }))
+        save_metrics(rg, metrics, config_dir)
+        #raised once the config is written, so 'add' can retry the failed files
+        if len(failed):
+            raise RequestException("Failed to add %d files" % (len(failed)))
+
+        if hold:
+            call_docker_attach(
+                host=host,
+                sudo=sudo,
+                name=name
             )
 
-        mounts[config_dir] = "/config"
-        job_conf = string.Template(JOB_CHILD_CONF).substitute(
-            TAG=galaxy,
-            NAME=name,
-            COMMON_VOLUMES=common_volumes,
-            SMP_DESTINATIONS="\n".join(smp_destinations),
-            SMP_TOOLS="\n".join(smp_tools)
-        )
-        with open( os.path.join(config_dir, "job_conf.xml"), "w" ) as handle:
-            handle.write(job_conf)
-        env["GALAXY_CONFIG_JOB_CONFIG_FILE"] = "/config/job_conf.xml"
-        #env['GALAXY_CONFIG_OUTPUTS_TO_WORKING_DIRECTORY'] = "True"
-        env['DOCKER_PARENT'] = "True"
-        privledged=True
-        mounts['/var/run/docker.sock'] = '/var/run/docker.sock'
+        return rg
 
-    if cpus is not None:
-        env['SLURM_CPUS'] = cpus
-
-    call_docker_run(
-        galaxy,
-        ports={str(port) : "80"},
-        host=host,
-        sudo=sudo,
-        name=name,
-        mounts=mounts,
-        privledged=privledged,
-        env=env
+def hash_file(hasher, path, buffer_size=1024*1024):
+    with open(path, "rb") as handle:
+        while True:
+            chunk = handle.read(buffer_size)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher
+
+
+class PathMapper(object):
+    """
+    Translates host paths into container paths using the longest mounted
+    host directory that contains them. Mounts are kept in a trie of path
+    components, so a lookup costs one step per component of the path, and
+    /data/lib1 never matches /data/lib10.
+    """
+
+    def __init__(self, mapping={}):
+        self.root = {}
+        for host_path, container_path in mapping.items():
+            self.add(host_path, container_path)
+
+    def split(self, path):
+        return list( a for a in os.path.abspath(path).split(os.sep) if len(a) )
+
+    def add(self, host_path, container_path):
+        node = self.root
+        for c in self.split(host_path):
+            node = node.setdefault(c, {})
+        node[None] = container_path
+
+    def translate(self, path):
+        parts = self.split(path)
+        node = self.root
+        best = None
+        for i, c in enumerate(parts):
+            if None in node:
+                best = (i, node[None])
+            node = node.get(c, None)
+            if node is None:
+                break
+        if node is not None and None in node:
+            best = (len(parts), node[None])
+        if best is None:
+            raise Exception("Path not in mounted lib_data directories: %s" % (os.path.abspath(path)))
+        return "/".join([best[1].rstrip("/")] + parts[best[0]:])
+
+    def translate_many(self, paths):
+        """
+        Translate a batch of paths, looking up each parent directory once.
+        """
+        dirs = {}
+        out = []
+        for path in paths:
+            d, name = os.path.split(os.path.abspath(path))
+            if d not in dirs:
+                try:
+                    dirs[d] = self.translate(d)
+                except Exception:
+                    dirs[d] = None
+            if dirs[d] is None:
+                out.append(self.translate(path))
+            else:
+                out.append(dirs[d] + "/" + name)
+        return out
+
+
+def galaxy_session(pool_size=10, retries=3, backoff=0.5):
+    """
+    Build a keep-alive HTTP session with a connection pool of pool_size
+    connections per host. Connection failures are retried for every method,
+    5xx responses only for idempotent ones, so a POST is never replayed once
+    the server has seen it. The session can be shared between threads.
+    """
+    session = requests.Session()
+    retry = Retry(
+        total=retries, connect=retries, read=retries, status=retries,
+        backoff_factor=backoff,
+        status_forcelist=[500, 502, 503, 504],
+        raise_on_status=False
     )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({
+        'Accept-Encoding' : 'gzip, deflate',
+        'Connection' : 'keep-alive'
+    })
+    return session
+
+
+GALAXY_ID_RE = re.compile(r"^(F?[0-9a-f]{16,}|[0-9]+)$")
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+def endpoint_template(path):
+    """
+    The API path with encoded ids and numbers replaced by {id}, so requests
+    for different objects are counted under one endpoint.
+    """
+    path = path.split("?")[0]
+    return "/".join( "{id}" if GALAXY_ID_RE.match(a) else a for a in path.split("/") )
+
+
+class GalaxyMetrics(object):
+    """
+    Request counts, latency histograms, bytes sent and received, and status
+    codes, per method and endpoint template. Can be shared by several
+    RemoteGalaxy objects and updated from any thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, method, path, status, seconds, sent=0, received=0):
+        key = (method, endpoint_template(path))
+        with self.lock:
+            ep = self.endpoints.get(key, None)
+            if ep is None:
+                ep = {'count' : 0, 'seconds' : 0.0, 'max' : 0.0, 'sent' : 0, 'received' : 0,
+                    'buckets' : [0] * len(LATENCY_BUCKETS), 'status' : {}}
+                self.endpoints[key] = ep
+            ep['count'] += 1
+            ep['seconds'] += seconds
+            ep['max'] = max(ep['max'], seconds)
+            ep['sent'] += sent
+            ep['received'] += received
+            for i, b in enumerate(LATENCY_BUCKETS):
+                if seconds <= b:
+                    ep['buckets'][i] += 1
+            ep['status'][str(status)] = ep['status'].get(str(status), 0) + 1
+
+    def to_json(self):
+        out = []
+        with self.lock:
+            for (method, endpoint), ep in sorted(self.endpoints.items()):
+                rec = copy.deepcopy(ep)
+                rec['method'] = method
+                rec['endpoint'] = endpoint
+                rec['buckets'] = dict( (str(b), n) for b, n in zip(LATENCY_BUCKETS, ep['buckets']) )
+                out.append(rec)
+        return {'le' : LATENCY_BUCKETS, 'endpoints' : out}
+
+    def to_prometheus(self, prefix="warpdrive_galaxy"):
+        """
+        The metrics in the Prometheus text exposition format, e.g. for the
+        node exporter's textfile collector.
+        """
+        def labels(method, endpoint, **extra):
+            items = [('method', method), ('endpoint', endpoint)] + sorted(extra.items())
+            return "{%s}" % ",".join( '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                for k, v in items )
+
+        with self.lock:
+            endpoints = sorted( (k, copy.deepcopy(v)) for k, v in self.endpoints.items() )
+        lines = [
+            "# HELP %s_request_seconds Galaxy API request latency" % (prefix),
+            "# TYPE %s_request_seconds histogram" % (prefix)
+        ]
+        for (method, endpoint), ep in endpoints:
+            for b, n in zip(LATENCY_BUCKETS, ep['buckets']):
+                lines.append("%s_request_seconds_bucket%s %d" % (prefix, labels(method, endpoint, le=repr(b)), n))
+            lines.append("%s_request_seconds_bucket%s %d" % (prefix, labels(method, endpoint, le="+Inf"), ep['count']))
+            lines.append("%s_request_seconds_sum%s %f" % (prefix, labels(method, endpoint), ep['seconds']))
+            lines.append("%s_request_seconds_count%s %d" % (prefix, labels(method, endpoint), ep['count']))
+        lines.append("# HELP %s_responses_total Galaxy API responses by status code" % (prefix))
+        lines.append("# TYPE %s_responses_total counter" % (prefix))
+        for (method, endpoint), ep in endpoints:
+            for status, n in sorted(ep['status'].items()):
+                lines.append("%s_responses_total%s %d" % (prefix, labels(method, endpoint, status=status), n))
+        for name, key, desc in [("request_bytes", "sent", "sent to"), ("response_bytes", "received", "received from")]:
+            lines.append("# HELP %s_%s_total Bytes %s the Galaxy API" % (prefix, name, desc))
+            lines.append("# TYPE %s_%s_total counter" % (prefix, name))
+            for (method, endpoint), ep in endpoints:
+                lines.append("%s_%s_total%s %d" % (prefix, name, labels(method, endpoint), ep[key]))
+        return "\n".join(lines) + "\n"
+
+    def save(self, path, format="json"):
+        """
+        Write the metrics as JSON, or in the Prometheus text format when
+        format is 'prometheus'. The file is replaced atomically.
+        """
+        if format == "prometheus":
+            write_atomic(path, self.to_prometheus())
+        else:
+            write_atomic(path, json.dumps(self.to_json(), indent=2))
+        return path
 
-    web_host="localhost"
-    if 'DOCKER_HOST' in os.environ:
-        u = urlparse.urlparse(os.environ['DOCKER_HOST'])
-        web_host = u.netloc.split(":")[0]
-
-    timeout_time = time.time() + timeout
-    while True:
-        if time.time() > timeout_time:
-            raise Exception("Startup Timed out")
-        time.sleep(3)
-        try:
-            url = "http://%s:%s/api/tools?key=%s" % (web_host, port, key)
-            logging.debug("Pinging: %s" % (url))
-            res = requests.get(url, timeout=3)
-            if res.status_code / 100 == 5:
-                continue
-            if res.status_code in [404, 403]:
-                continue
-            break
-        except requests.exceptions.ConnectionError:
-            pass
-        except requests.exceptions.Timeout:
-            pass
 
-    rg = RemoteGalaxy("http://%s:%s"  % (web_host, port), 'admin', path_mapping=lib_mapping)
-    library_id = rg.create_library("Imported")
-    folder_id = rg.library_find_contents(library_id, "/")['id']
-    for data in data_load:
-        logging.info("Loading: %s" % (data))
-        md = {}
-        if data in meta_data:
-            md = meta_data[data]
-        rg.library_paste_file(library_id, folder_id, os.path.basename(data), data, uuid=md.get('uuid', None))
-
-    with open(os.path.join(config_dir, "config.json"), "w") as handle:
-        handle.write(json.dumps({
-            'galaxy' : galaxy,
-            'port' : port,
-            'lib_data' : list(os.path.abspath(a) for a in lib_data),
-            'host' : web_host,
-            'tool_dir' : os.path.abspath(tool_dir) if tool_dir is not None else None,
-            'tool_data' : os.path.abspath(tool_data) if tool_data is not None else None,
-            'metadata_suffix' : metadata_suffix,
-            'tool_docker' : tool_docker,
-            'key' : key,
-            'lib_mapping' : lib_mapping
-        }))
-
-    if hold:
-        call_docker_attach(
-            host=host,
-            sudo=sudo,
-            name=name
-        )
+def save_metrics(rg, format, config_dir):
+    if format is None:
+        return
+    path = os.path.join(config_dir, "metrics.prom" if format == "prometheus" else "metrics.json")
+    rg.metrics.save(path, format)
+    logging.info("Wrote Galaxy API metrics to %s" % (path))
 
-    return rg
 
 class RemoteGalaxy(object):
 
-    def __init__(self, url, api_key, path_mapping={}):
+    def __init__(self, url, api_key, path_mapping={}, pool_size=10, retries=3, backoff=0.5, session=None,
+        cache_ttl=300, metrics=None):
         self.url = url
         self.api_key = api_key
         self.path_mapping = path_mapping
+        self.path_mapper = PathMapper(path_mapping)
+        if session is None:
+            session = galaxy_session(pool_size=pool_size, retries=retries, backoff=backoff)
+        self.session = session
+        self.metrics = metrics if metrics is not None else GalaxyMetrics()
+        #name -> library and, per library, path -> item maps, with load times
+        self.cache_ttl = cache_ttl
+        self.cache_lock = threading.Lock()
+        self.library_cache = None
+        self.contents_cache = {}
+
+    def request(self, method, path, params=None, data=None, headers=None, stream=False, timeout=None, key=True):
+        """
+        Send a request through the session, recording its latency, size and
+        status in self.metrics. For streamed responses the received size is
+        taken from Content-Length, as the body has not been read yet.
+        """
+        params = dict(params) if params is not None else {}
+        if key:
+            params['key'] = self.api_key
+        sent = len(data) if data is not None else 0
+        start = time.time()
+        try:
+            r = self.session.request(method, self.url + path, params=params, data=data, headers=headers,
+                stream=stream, timeout=timeout)
+        except requests.exceptions.RequestException:
+            self.metrics.record(method, path, "error", time.time() - start, sent, 0)
+            raise
+        if stream:
+            received = long(r.headers.get('Content-Length', None) or 0)
+        else:
+            received = len(r.content)
+        self.metrics.record(method, path, r.status_code, time.time() - start, sent, received)
+        return r
 
     def get(self, path, params = {}):
-        c_url = self.url + path
-        params['key'] = self.api_key
-        req = requests.get(c_url, params=params)
+        req = self.request("GET", path, params=params)
         return req.json()
 
     def post(self, path, payload, params={}):
-        c_url = self.url + path
-        params['key'] = self.api_key
-        logging.debug("POSTING: %s %s" % (c_url, json.dumps(payload)))
-        req = requests.post(c_url, data=json.dumps(payload), params=params, headers = {'Content-Type': 'application/json'} )
-        print req.text
+        data = json.dumps(payload)
+        logging.debug("POSTING: %s%s %s" % (self.url, path, data[:1000]))
+        req = self.request("POST", path, params=params, data=data, headers = {'Content-Type': 'application/json'} )
+        logging.debug("Response %s: %s" % (req.status_code, req.text[:1000]))
         return req.json()
 
     def post_text(self, path, payload, params=None):
-        c_url = self.url + path
-        if params is None:
-            params = {}
-        params['key'] = self.api_key
-        logging.debug("POSTING: %s %s" % (c_url, json.dumps(payload)))
-        req = requests.post(c_url, data=json.dumps(payload), params=params, headers = {'Content-Type': 'application/json'} )
+        data = json.dumps(payload)
+        logging.debug("POSTING: %s%s %s" % (self.url, path, data[:1000]))
+        req = self.request("POST", path, params=params, data=data, headers = {'Content-Type': 'application/json'} )
         return req.text
 
-    def download_handle(self, path):
-        url = self.url + path
-        logging.info("Downloading: %s" % (url))
-        params = {}
-        params['key'] = self.api_key
-        r = requests.get(url, params=params, stream=True)
-        return r
+    def download_handle(self, path, headers=None):
+        logging.info("Downloading: %s%s" % (self.url, path))
+        return self.request("GET", path, stream=True, headers=headers)
 
-    def download(self, path, dst):
-        r = self.download_handle(path)
+    def ping(self, timeout=3):
+        logging.debug("Pinging: %s/api/version" % (self.url))
+        try:
+            res = self.request("GET", "/api/version", timeout=timeout, key=False)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            return False
+        return res.status_code == 200
+
+    def download_range_info(self, path):
+        """
+        Returns the total size of path if the server honours Range requests,
+        otherwise None.
+        """
+        r = self.download_handle(path, headers={'Range' : 'bytes=0-0'})
+        r.close()
+        if r.status_code != 206:
+            return None
+        content_range = r.headers.get('Content-Range', '')
+        if '/' not in content_range or content_range.endswith('/*'):
+            return None
+        return long(content_range.split('/')[-1])
+
+    def download_segment(self, path, dst, start, end, buffer_size):
+        r = self.download_handle(path, headers={'Range' : 'bytes=%d-%d' % (start, end)})
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise Exception("Range request not honoured for %s" % (path))
         dsize = 0L
+        with open(dst, "r+b") as handle:
+            handle.seek(start)
+            for chunk in r.iter_content(chunk_size=buffer_size):
+                if chunk:
+                    handle.write(chunk)
+                    dsize += len(chunk)
+        if dsize != end - start + 1:
+            raise Exception("Short read on %s bytes %d-%d" % (path, start, end))
+        return dsize
+
+    def download(self, path, dst, buffer_size=1024*1024, segments=1, resume=False, checksum=None, verify=None):
+        """
+        Download path to dst, a file name or a writable handle. Large files
+        can be fetched as parallel ranged segments when the server supports
+        Range requests, and an interrupted download to a file name is resumed
+        from its '.part' file when resume is set. With checksum set to a
+        hashlib algorithm the digest of the file is computed, and compared
+        against verify if given, raising on a mismatch. Returns a dict with the bytes transferred,
+        the file size, elapsed seconds, rate in bytes/sec and the digest.
+        """
+        start = time.time()
+        hasher = None
+        if checksum is not None or verify is not None:
+            hasher = hashlib.new(checksum if checksum is not None else "md5")
+        dsize = 0L
+
         if hasattr(dst, 'write'):
-            for chunk in r.iter_content(chunk_size=1024):
+            r = self.download_handle(path)
+            r.raise_for_status()
+            for chunk in r.iter_content(chunk_size=buffer_size):
                 if chunk:
                     dst.write(chunk)
                     dsize += len(chunk)
+                    if hasher is not None:
+                        hasher.update(chunk)
+            size = dsize
+            if verify is not None and hasher.hexdigest() != verify:
+                raise Exception("Checksum mismatch for %s: %s != %s" % (path, hasher.hexdigest(), verify))
         else:
-            with open(dst, "wb") as handle:
-                for chunk in r.iter_content(chunk_size=1024):
-                    if chunk:
-                        handle.write(chunk)
-                        handle.flush()
-                        dsize += len(chunk)
-        logging.info("Downloaded: %s bytes" % (dsize))
+            part = dst + ".part"
+            total = None
+            if segments > 1 or resume:
+                total = self.download_range_info(path)
+            offset = 0L
+            if resume and total is not None and os.path.exists(part):
+                offset = os.path.getsize(part)
+                if offset > total:
+                    offset = 0L
+
+            if offset == 0 and segments > 1 and total is not None and total > buffer_size * segments:
+                seg = dst + ".seg"
+                with open(seg, "wb") as handle:
+                    handle.truncate(total)
+                step = total / segments + 1
+                ranges = list( (a, min(a + step, total) - 1) for a in range(0, total, step) )
+                results = run_pool(lambda r: self.download_segment(path, seg, r[0], r[1], buffer_size), ranges, workers=segments)
+                errors = list(err for r, res, err in results if err is not None)
+                if len(errors):
+                    #a partly filled sparse file can't be resumed from
+                    os.unlink(seg)
+                    raise errors[0]
+                dsize = sum(res for r, res, err in results)
+                os.rename(seg, part)
+                if hasher is not None:
+                    hash_file(hasher, part, buffer_size)
+            elif total is None or offset < total:
+                headers = None
+                if offset > 0:
+                    logging.info("Resuming %s at %d bytes" % (dst, offset))
+                    headers = {'Range' : 'bytes=%d-' % (offset)}
+                r = self.download_handle(path, headers=headers)
+                r.raise_for_status()
+                if offset > 0 and r.status_code != 206:
+                    offset = 0L
+                if hasher is not None and offset > 0:
+                    hash_file(hasher, part, buffer_size)
+                with open(part, "ab" if offset > 0 else "wb", buffer_size) as handle:
+                    for chunk in r.iter_content(chunk_size=buffer_size):
+                        if chunk:
+                            handle.write(chunk)
+                            dsize += len(chunk)
+                            if hasher is not None:
+                                hasher.update(chunk)
+            elif hasher is not None:
+                hash_file(hasher, part, buffer_size)
+            size = os.path.getsize(part)
+            if verify is not None and hasher.hexdigest() != verify:
+                os.unlink(part)
+                raise Exception("Checksum mismatch for %s: %s != %s" % (dst, hasher.hexdigest(), verify))
+            os.rename(part, dst)
+
+        elapsed = max(time.time() - start, 1e-6)
+        logging.info("Downloaded: %s bytes in %.1f sec (%.1f MB/s)" % (dsize, elapsed, dsize / elapsed / 1048576))
+        TRACE.count("bytes_downloaded", dsize)
+        TRACE.count("files_downloaded")
+        return {
+            'bytes' : dsize,
+            'size' : size,
+            'seconds' : elapsed,
+            'rate' : dsize / elapsed,
+            'checksum' : hasher.hexdigest() if hasher is not None else None
+        }
 
     def create_library(self, name):
         lib_create_data = {'name' : name}
         library = self.post('/api/libraries', lib_create_data)
         library_id = library['id']
+        self.invalidate_cache()
         return library_id
 
+    def invalidate_cache(self, library_id=None):
+        with self.cache_lock:
+            if library_id is None:
+                self.library_cache = None
+                self.contents_cache = {}
+            else:
+                self.contents_cache.pop(library_id, None)
+
+    def cache_fresh(self, entry):
+        return entry is not None and time.time() - entry[0] < self.cache_ttl
+
     def library_find(self, name):
-        for d in self.library_list():
-            if d['name'] == name:
-                return d
-        return None
+        with self.cache_lock:
+            entry = self.library_cache
+        if not self.cache_fresh(entry):
+            entry = (time.time(), dict( (d['name'], d) for d in self.library_list() ))
+            with self.cache_lock:
+                self.library_cache = entry
+        return entry[1].get(name, None)
 
     def library_list(self):
         return self.get("/api/libraries")
@@ -533,11 +2456,36 @@ class RemoteGalaxy(object):
     def library_list_contents(self, library_id):
         return self.get("/api/libraries/%s/contents" % library_id)
 
+    def library_iter_contents(self, library_id, page_size=5000):
+        """
+        Iterate over the contents of a library, requesting them page_size
+        items at a time. Servers that ignore paging return everything in the
+        first response, which is detected and not requested again.
+        """
+        offset = 0
+        first = None
+        while True:
+            page = self.get("/api/libraries/%s/contents" % library_id, {'limit' : page_size, 'offset' : offset})
+            if not len(page):
+                return
+            if first is None:
+                first = page[0]['id']
+            elif page[0]['id'] == first:
+                return
+            for a in page:
+                yield a
+            if len(page) != page_size:
+                return
+            offset += page_size
+
     def library_find_contents(self, library_id, name):
-        for a in self.library_list_contents(library_id):
-            if a['name'] == name:
-                return a
-        return None
+        with self.cache_lock:
+            entry = self.contents_cache.get(library_id, None)
+        if not self.cache_fresh(entry):
+            entry = (time.time(), dict( (a['name'], a) for a in self.library_iter_contents(library_id) ))
+            with self.cache_lock:
+                self.contents_cache[library_id] = entry
+        return entry[1].get(name, None)
 
     def library_get_contents(self, library_id, ldda_id):
         return self.get("/api/libraries/%s/contents/%s" % (library_id, ldda_id))
@@ -548,9 +2496,9 @@ class RemoteGalaxy(object):
     def get_dataset(self, id, src='hda' ):
         return self.get("/api/datasets/%s?hda_ldda=%s" % (id, src))
 
-    def download_hda(self, history, hda, dst):
+    def download_hda(self, history, hda, dst, **kwds):
         meta = self.get_hda(history, hda)
-        self.download(meta['download_url'], dst)
+        return self.download(meta['download_url'], dst, **kwds)
 
     def history_list(self):
         return self.get("/api/histories")
@@ -558,6 +2506,68 @@ class RemoteGalaxy(object):
     def get_history(self, history):
         return self.get("/api/histories/%s" % (history))
 
+    def history_contents(self, history):
+        return self.get("/api/histories/%s/contents" % (history), {
+            'v' : 'dev',
+            'keys' : 'id,hid,name,extension,file_size,state,deleted,purged,visible,history_content_type'
+        })
+
+    def export_history(self, history, dst_dir, workers=4, **kwds):
+        """
+        Download every finished dataset of a history into dst_dir as
+        <hid>_<name>, using bounded concurrency. The contents are listed in a
+        single request and datasets already present with a matching size are
+        skipped. A manifest.json describing the export is written to dst_dir
+        and returned. Extra keyword arguments are passed to download.
+        """
+        meta = self.get_history(history)
+        if not os.path.exists(dst_dir):
+            os.makedirs(dst_dir)
+        datasets = []
+        for item in self.history_contents(history):
+            if item.get('history_content_type', 'dataset') != 'dataset':
+                continue
+            if item.get('deleted', False) or item.get('purged', False) or item.get('state', 'ok') != 'ok':
+                continue
+            datasets.append(item)
+
+        def fetch(item):
+            name = re.sub(r"[^\w.-]+", "_", item.get('name', None) or item['id'])
+            path = os.path.join(dst_dir, "%s_%s" % (item.get('hid', ''), name))
+            out = {
+                'id' : item['id'],
+                'hid' : item.get('hid', None),
+                'name' : item.get('name', None),
+                'extension' : item.get('extension', None),
+                'file_size' : item.get('file_size', None),
+                'path' : os.path.relpath(path, dst_dir)
+            }
+            if item.get('file_size', None) is not None and os.path.exists(path) and os.path.getsize(path) == item['file_size']:
+                out['status'] = 'skipped'
+                return out
+            url = "/api/histories/%s/contents/%s/display" % (history, item['id'])
+            if item.get('extension', None) is not None:
+                url += "?to_ext=%s" % (item['extension'])
+            out.update(self.download(url, path, **kwds))
+            out['status'] = 'downloaded'
+            return out
+
+        start = time.time()
+        results = []
+        for item, out, err in run_pool(fetch, datasets, workers=workers):
+            if err is not None:
+                out = {'id' : item['id'], 'hid' : item.get('hid', None), 'name' : item.get('name', None), 'status' : 'failed', 'error' : str(err)}
+            results.append(out)
+        manifest = {
+            'history' : history,
+            'name' : meta.get('name', None),
+            'seconds' : time.time() - start,
+            'datasets' : results
+        }
+        with open(os.path.join(dst_dir, "manifest.json"), "w") as handle:
+            handle.write(json.dumps(manifest, indent=1))
+        return manifest
+
     def get_provenance(self, history, hda, follow=False):
         if follow:
             return self.get("/api/histories/%s/contents/%s/provenance" % (history, hda), {"follow" : True})
@@ -565,7 +2575,7 @@ class RemoteGalaxy(object):
             return self.get("/api/histories/%s/contents/%s/provenance" % (history, hda))
 
     def add_workflow(self, wf):
-        self.post("/api/workflows/upload", { 'workflow' : wf } )
+        return self.post("/api/workflows/upload", { 'workflow' : wf } )
 
     def get_workflow(self, wid):
         return self.get("/api/workflows/%s" % (wid))
@@ -573,89 +2583,753 @@ class RemoteGalaxy(object):
     def call_workflow(self, request):
         return self.post("/api/workflows", request, params={'step_details' : True} )
 
+    def call_workflows(self, workflow_id, rows, concurrency=4, rate=None, history=None):
+        """
+        Submit one invocation of a workflow per row of rows. Each row maps
+        workflow inputs, by step id or label, to a dataset id or to a
+        {'src', 'id'} dict; a 'history' entry sets the target history of that
+        row, otherwise history is used. Invocations are submitted by at most
+        concurrency threads and no faster than rate per second. Returns one
+        dict per row with the invocation id, history, step job ids and error.
+        """
+        workflow = self.get_workflow(workflow_id)
+        steps = {}
+        for step_id, step in workflow.get('inputs', {}).items():
+            steps[step_id] = step_id
+            if step.get('label', None) is not None:
+                steps[step['label']] = step_id
+        limiter = RateLimiter(rate) if rate is not None else None
+
+        def submit(i):
+            row = rows[i]
+            ds_map = {}
+            for k, v in row.items():
+                if k == 'history':
+                    continue
+                if k not in steps:
+                    raise Exception("Workflow %s has no input %s" % (workflow_id, k))
+                if not isinstance(v, dict):
+                    v = {'src' : 'hda', 'id' : v}
+                ds_map[steps[k]] = v
+            request = {'workflow_id' : workflow_id, 'ds_map' : ds_map}
+            if row.get('history', history) is not None:
+                #a bare value would be taken as the name of a new history
+                request['history'] = "hist_id=%s" % (row.get('history', history))
+            if limiter is not None:
+                limiter.wait()
+            return self.call_workflow(request)
+
+        results = []
+        for i, res, err in run_pool(submit, range(len(rows)), workers=concurrency):
+            out = {'row' : i, 'invocation_id' : None, 'history' : None, 'jobs' : [], 'error' : None}
+            if err is not None:
+                out['error'] = str(err)
+            elif 'err_msg' in res:
+                out['error'] = res['err_msg']
+            else:
+                out['invocation_id'] = res.get('id', None)
+                out['history'] = res.get('history_id', res.get('history', None))
+                step_list = res.get('steps', [])
+                if isinstance(step_list, dict):
+                    step_list = step_list.values()
+                out['jobs'] = list( a['job_id'] for a in step_list if isinstance(a, dict) and a.get('job_id', None) is not None )
+            results.append(out)
+        return results
+
     def get_job(self, jid):
         return self.get("/api/jobs/%s" % (jid), {'full' : True} )
 
-    def library_paste_file(self, library_id, library_folder_id, name, datapath, uuid=None, metadata=None):
-        datapath = os.path.abspath(datapath)
-        found = False
-        for ppath, dpath in self.path_mapping.items():
-            if datapath.startswith(ppath):
-                datapath = os.path.join(dpath, os.path.relpath(datapath, ppath))
-                found = True
-                break
-        if not found:
-            raise Exception("Path not in mounted lib_data directories: %s" % (datapath))
+    def get_job_state(self, jid):
+        return self.get("/api/jobs/%s" % (jid))
+
+    def map_path(self, datapath):
+        return self.path_mapper.translate(datapath)
+
+    def library_paste_payload(self, library_folder_id, datapaths, metadata=None):
         data = {}
         data['folder_id'] = library_folder_id
         data['file_type'] = 'auto'
-        data['name'] = name
-        if uuid is not None:
-            data['uuid'] = uuid
         data['dbkey'] = ''
         data['upload_option'] = 'upload_paths'
         data['create_type'] = 'file'
         data['link_data_only'] = 'link_to_files'
         if metadata is not None:
             data['extended_metadata'] = metadata
-        data['filesystem_paths'] = datapath
-        logging.info("Pasting %s: %s" % (name, datapath))
-        libset = self.post("/api/libraries/%s/contents" % library_id, data)
-        print libset
+        data['filesystem_paths'] = "\n".join(self.path_mapper.translate_many(datapaths))
+        return data
+
+    def library_paste_file(self, library_id, library_folder_id, name, datapath, uuid=None, metadata=None):
+        data = self.library_paste_payload(library_folder_id, [datapath], metadata)
+        data['name'] = name
+        if uuid is not None:
+            data['uuid'] = uuid
+        logging.info("Pasting %s: %s" % (name, data['filesystem_paths']))
+        libset = self.library_paste(library_id, data)
+        logging.debug("Pasted %s: %s" % (name, libset))
         return libset[0]
 
+    def library_paste_files(self, library_id, library_folder_id, datapaths, metadata=None):
+        data = self.library_paste_payload(library_folder_id, datapaths, metadata)
+        logging.info("Pasting %d files into folder %s" % (len(datapaths), library_folder_id))
+        return self.library_paste(library_id, data)
+
+    def library_paste(self, library_id, data):
+        """
+        Post a paste payload, raising on an HTTP error or on any response
+        that is not the list of created datasets.
+        """
+        req = self.request("POST", "/api/libraries/%s/contents" % library_id, data=json.dumps(data),
+            headers = {'Content-Type': 'application/json'})
+        self.invalidate_cache(library_id)
+        try:
+            libset = req.json()
+        except ValueError:
+            libset = None
+        if req.status_code >= 400 or not isinstance(libset, list) or not len(libset):
+            msg = libset.get('err_msg', libset) if isinstance(libset, dict) else req.text[:200]
+            raise Exception("Library paste failed (HTTP %s): %s" % (req.status_code, msg))
+        return libset
+
+
+JOB_TERMINAL_STATES = ['ok', 'error', 'deleted', 'deleted_new', 'stopped', 'skipped']
+
+class JobFuture(object):
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.job = None
+        self.error = None
+        self.event = threading.Event()
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def done(self):
+        return self.event.is_set()
+
+    def result(self, timeout=None):
+        if not self.event.wait(timeout):
+            raise Exception("Timed out waiting for job %s" % (self.job_id))
+        if self.error is not None:
+            raise self.error
+        return self.job
+
+    def add_done_callback(self, func):
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(func)
+                return
+        func(self)
+
+    def set_result(self, job, error=None):
+        with self.lock:
+            self.job = job
+            self.error = error
+            self.event.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception, e:
+                logging.error("Callback for job %s failed: %s" % (self.job_id, e))
+
+
+class JobWatcher(object):
+    """
+    Tracks many Galaxy jobs from a single scheduler thread and a small pool
+    of pollers. Each job is polled with the cheap state-only job query; the
+    polling interval of a job starts at min_interval, grows by backoff while
+    its state doesn't change and resets when it does. Jobs in a terminal
+    state are dropped and their futures completed; paused jobs are not
+    terminal, they are watched until resumed or deleted. A job that fails to
+    give a state max_errors times in a row is dropped and its future failed.
+    """
+
+    def __init__(self, rg, workers=4, min_interval=1.0, max_interval=60.0, backoff=1.5, max_errors=10):
+        self.rg = rg
+        self.max_errors = max_errors
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.cond = threading.Condition()
+        self.heap = []
+        self.jobs = {}
+        self.work = Queue.Queue()
+        self.seq = itertools.count()
+        self.running = True
+        self.started = time.time()
+        self.counts = {'polls' : 0, 'errors' : 0, 'completed' : 0, 'in_flight' : 0}
+        self.threads = [threading.Thread(target=self.schedule)]
+        for i in range(workers):
+            self.threads.append(threading.Thread(target=self.poll))
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def watch(self, job_id, callback=None):
+        with self.cond:
+            if job_id in self.jobs:
+                future = self.jobs[job_id]['future']
+            else:
+                future = JobFuture(job_id)
+                self.jobs[job_id] = {'future' : future, 'state' : None, 'interval' : self.min_interval, 'errors' : 0}
+                heapq.heappush(self.heap, (time.time(), next(self.seq), job_id))
+                self.cond.notify()
+        if callback is not None:
+            future.add_done_callback(callback)
+        return future
+
+    def schedule(self):
+        while True:
+            with self.cond:
+                while self.running and (not len(self.heap) or self.heap[0][0] > time.time()):
+                    if len(self.heap):
+                        self.cond.wait(self.heap[0][0] - time.time())
+                    else:
+                        self.cond.wait()
+                if not self.running:
+                    return
+                due, seq, job_id = heapq.heappop(self.heap)
+                self.counts['in_flight'] += 1
+            self.work.put(job_id)
+
+    def poll(self):
+        while True:
+            job_id = self.work.get()
+            if job_id is None:
+                return
+            job = None
+            try:
+                job = self.rg.get_job_state(job_id)
+            except Exception, e:
+                logging.warning("Polling job %s failed: %s" % (job_id, e))
+            state = job.get('state', None) if isinstance(job, dict) else None
+            done = None
+            error = None
+            #decide completion and take the future under the lock, so a watch()
+            #of the same id in between can't orphan it
+            with self.cond:
+                self.counts['in_flight'] -= 1
+                self.counts['polls'] += 1
+                entry = self.jobs[job_id]
+                if state is None:
+                    self.counts['errors'] += 1
+                    entry['errors'] += 1
+                    entry['interval'] = min(entry['interval'] * self.backoff, self.max_interval)
+                    if entry['errors'] >= self.max_errors:
+                        error = Exception("No state for job %s after %d polls: %s" % (job_id, entry['errors'], job))
+                else:
+                    entry['errors'] = 0
+                    if state in JOB_TERMINAL_STATES:
+                        self.counts['completed'] += 1
+                    elif state != entry['state']:
+                        entry['state'] = state
+                        entry['interval'] = self.min_interval
+                    else:
+                        entry['interval'] = min(entry['interval'] * self.backoff, self.max_interval)
+                if error is not None or state in JOB_TERMINAL_STATES:
+                    del self.jobs[job_id]
+                    done = entry['future']
+                else:
+                    heapq.heappush(self.heap, (time.time() + entry['interval'], next(self.seq), job_id))
+                    self.cond.notify()
+            if done is not None:
+                done.set_result(job, error)
+
+    def wait(self, timeout=None):
+        end = None if timeout is None else time.time() + timeout
+        with self.cond:
+            futures = list(e['future'] for e in self.jobs.values())
+        for f in futures:
+            #failed jobs are reported through their own futures
+            if not f.event.wait(None if end is None else max(end - time.time(), 0)):
+                raise Exception("Timed out waiting for job %s" % (f.job_id))
+
+    def stats(self):
+        with self.cond:
+            elapsed = max(time.time() - self.started, 1e-6)
+            return {
+                'watching' : len(self.jobs),
+                'queued' : len(self.heap),
+                'in_flight' : self.counts['in_flight'],
+                'polls' : self.counts['polls'],
+                'errors' : self.counts['errors'],
+                'completed' : self.counts['completed'],
+                'polls_per_sec' : self.counts['polls'] / elapsed,
+                'completed_per_sec' : self.counts['completed'] / elapsed
+            }
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        for t in self.threads[1:]:
+            self.work.put(None)
+        for t in self.threads:
+            t.join()
+
+
+class ProvenanceCrawler(object):
+    """
+    Builds the lineage DAG of a set of history datasets. Datasets and jobs
+    are fetched at most once per id, each level of the frontier is fetched
+    concurrently, and the cache is kept between crawls. Edges run from an
+    input dataset to the job that used it, and from a job to its output.
+    """
+
+    def __init__(self, rg, workers=8):
+        self.rg = rg
+        self.workers = workers
+        self.nodes = {}
+        self.edges = set()
+        self.lock = threading.Lock()
+
+    def fetch_dataset(self, item):
+        dataset_id, src, history = item
+        ds = self.rg.get_dataset(dataset_id, src)
+        node = {
+            'type' : 'dataset',
+            'id' : dataset_id,
+            'src' : src,
+            'name' : ds.get('name', None),
+            'uuid' : ds.get('uuid', None),
+            'history_id' : ds.get('history_id', history),
+            'extension' : ds.get('extension', ds.get('file_ext', None))
+        }
+        job_id = ds.get('creating_job', None)
+        if job_id is None and src == 'hda' and node['history_id'] is not None:
+            job_id = self.rg.get_provenance(node['history_id'], dataset_id).get('job_id', None)
+        node['job_id'] = job_id
+        return node
+
+    def fetch_job(self, job_id):
+        job = self.rg.get_job(job_id)
+        return {
+            'type' : 'job',
+            'id' : job_id,
+            'tool_id' : job.get('tool_id', None),
+            'tool_version' : job.get('tool_version', None),
+            'state' : job.get('state', None),
+            'inputs' : job.get('inputs', {})
+        }
+
+    def crawl(self, starts):
+        """
+        Crawl the lineage of starts, a list of (history id, hda id) pairs.
+        """
+        datasets = list( (hda, 'hda', history) for history, hda in starts )
+        while len(datasets):
+            datasets = dict( (d[0], d) for d in datasets if "dataset:" + d[0] not in self.nodes ).values()
+            jobs = set()
+            for item, node, err in run_pool(self.fetch_dataset, datasets, workers=self.workers):
+                if err is not None:
+                    node = {'type' : 'dataset', 'id' : item[0], 'src' : item[1], 'error' : str(err), 'job_id' : None}
+                with self.lock:
+                    self.nodes["dataset:" + item[0]] = node
+                    if node['job_id'] is not None:
+                        self.edges.add( ("job:" + node['job_id'], "dataset:" + item[0]) )
+                        if "job:" + node['job_id'] not in self.nodes:
+                            jobs.add(node['job_id'])
+            datasets = []
+            for job_id, node, err in run_pool(self.fetch_job, jobs, workers=self.workers):
+                if err is not None:
+                    node = {'type' : 'job', 'id' : job_id, 'error' : str(err), 'inputs' : {}}
+                with self.lock:
+                    self.nodes["job:" + job_id] = node
+                for name, value in node.pop('inputs').items():
+                    if not isinstance(value, dict) or 'id' not in value:
+                        continue
+                    self.edges.add( ("dataset:" + value['id'], "job:" + job_id) )
+                    datasets.append( (value['id'], value.get('src', 'hda'), None) )
+        return self
+
+    def to_json(self):
+        return {
+            'nodes' : list(self.nodes[k] for k in sorted(self.nodes)),
+            'edges' : list( {'source' : a, 'target' : b} for a, b in sorted(self.edges) )
+        }
+
+    def to_graphml(self):
+        keys = ['type', 'name', 'tool_id', 'tool_version', 'state', 'uuid', 'history_id', 'extension', 'error']
+        lines = [
+            '<?xml version="1.0" encoding="UTF-8"?>',
+            '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">'
+        ]
+        for k in keys:
+            lines.append('  <key id="%s" for="node" attr.name="%s" attr.type="string"/>' % (k, k))
+        lines.append('  <graph id="provenance" edgedefault="directed">')
+        for node_id in sorted(self.nodes):
+            node = self.nodes[node_id]
+            lines.append('    <node id=%s>' % (quoteattr(node_id)))
+            for k in keys:
+                if node.get(k, None) is not None:
+                    lines.append('      <data key="%s">%s</data>' % (k, escape(unicode(node[k]))))
+            lines.append('    </node>')
+        for a, b in sorted(self.edges):
+            lines.append('    <edge source=%s target=%s/>' % (quoteattr(a), quoteattr(b)))
+        lines.append('  </graph>')
+        lines.append('</graphml>')
+        return "\n".join(lines) + "\n"
+
+    def save(self, path, format=None):
+        if format is None:
+            format = "graphml" if path.endswith(".graphml") else "json"
+        with open(path, "w") as handle:
+            if format == "graphml":
+                handle.write(self.to_graphml().encode("utf-8"))
+            else:
+                handle.write(json.dumps(self.to_json(), indent=1))
+
+
+def run_down(name="galaxy", host=None, rm=False, config_dir=DEFAULT_CONFIG, sudo=False, profile=None):
+    if config_dir is None:
+        config_dir = DEFAULT_CONFIG
+    config_dir = os.path.abspath(os.path.join(config_dir, "warpdrive_%s" % (name)))
+    with profile_trace(profile, config_dir, "down", name=name):
+        try:
+            with TRACE.span("docker_kill"):
+                call_docker_kill(
+                    name, host=host, sudo=sudo
+                )
+        except (subprocess.CalledProcessError, DockerAPIError):
+            pass
+        if rm:
+            with TRACE.span("docker_rm"):
+                call_docker_rm(
+                    name, host=host, sudo=sudo, volume_delete=True
+                )
+            if os.path.exists(config_dir):
+                with TRACE.span("remove_config"):
+                    shutil.rmtree(config_dir)
+
+
+def run_status(name="galaxy", host=None, sudo=False, config_dir=DEFAULT_CONFIG, ready=True):
+    """
+    Returns the status of the named instance, or of each instance if name
+    is a list, from a single name-filtered container query. Each status is a
+    dict with the container's state, status text, ports and uptime (since
+    creation), and, when ready is set and the instance config is found,
+    whether Galaxy answers on its port. Instances without a container have
+    the state 'NotFound'.
+    """
+    if config_dir is None:
+        config_dir = DEFAULT_CONFIG
+    names = [name] if isinstance(name, basestring) else list(name)
+    found = dict( (c['name'], c) for c in call_docker_ps(host=host, sudo=sudo, names=names) )
+    now = time.time()
+
+    def status(n):
+        c = found.get(n, {'name' : n, 'id' : None, 'image' : None, 'state' : 'NotFound', 'status' : None, 'ports' : [], 'created' : None})
+        c['uptime'] = None
+        if c['state'] == 'running' and c['created'] is not None:
+            c['uptime'] = now - c['created']
+        c['ready'] = None
+        config_file = os.path.join(config_dir, "warpdrive_%s" % (n), "config.json")
+        if ready and c['state'] == 'running' and os.path.exists(config_file):
+            with open(config_file) as handle:
+                config = json.loads(handle.read())
+            probe = RemoteGalaxy("http://%s:%s" % (config['host'], config['port']), None, pool_size=1, retries=0)
+            c['ready'] = probe.ping(timeout=2)
+        return c
+
+    out = list( res for n, res, err in run_pool(status, names, workers=min(len(names), 8)) )
+    if isinstance(name, basestring):
+        return out[0]
+    return out
+
+
+def format_uptime(seconds):
+    if seconds is None:
+        return "-"
+    seconds = int(seconds)
+    if seconds >= 86400:
+        return "%dd%dh" % (seconds / 86400, seconds % 86400 / 3600)
+    if seconds >= 3600:
+        return "%dh%dm" % (seconds / 3600, seconds % 3600 / 60)
+    return "%dm%ds" % (seconds / 60, seconds % 60)
+
+
+def print_status(records, as_json=False):
+    if as_json:
+        for r in records:
+            print json.dumps(r)
+        return
+    for r in records:
+        print "%s\t%s\t%s\t%s\t%s" % (
+            r['name'], r['state'], format_uptime(r['uptime']),
+            {True : "ready", False : "starting", None : "-"}[r['ready']],
+            ",".join(r['ports']) if len(r['ports']) else "-"
+        )
 
 
-def run_down(name="galaxy", host=None, rm=False, config_dir=DEFAULT_CONFIG, sudo=False):
+def cli_status(name=None, host=None, sudo=False, config_dir=DEFAULT_CONFIG, watch=None, as_json=False):
+    names = name if name is not None else ["galaxy"]
+    while True:
+        print_status(run_status(name=names, host=host, sudo=sudo, config_dir=config_dir), as_json=as_json)
+        if watch is None:
+            break
+        time.sleep(watch)
+        print
+
+
+def fleet_members(name="galaxy", names=None, count=None, port=8080, port_range=None):
+    """
+    Returns the (name, port) pairs of a fleet, given either explicit names,
+    a count of instances named <name>_<i>, or a port range 'first-last'.
+    Ports count up from port unless a range is given.
+    """
+    if port_range is not None:
+        first, last = (int(a) for a in port_range.split("-"))
+        ports = range(first, last + 1)
+        if names is None:
+            names = list("%s_%d" % (name, i) for i in range(len(ports)))
+        if len(names) != len(ports):
+            raise RequestException("%d names given for %d ports" % (len(names), len(ports)))
+    else:
+        if names is None:
+            if count is None:
+                raise RequestException("Fleet needs --names, --count or --port-range")
+            names = list("%s_%d" % (name, i) for i in range(count))
+        ports = range(int(port), int(port) + len(names))
+    return zip(names, ports)
+
+
+def fleet_ingest(instances, lib_data, metadata_suffix=None,
+    ingest_batch=100, ingest_workers=4, scan_workers=1, metadata_manifest=None, metadata_workers=1):
+    """
+    Scan lib_data once and deal batches of files round robin to the
+    instances, each of which pastes its share through its own ingest pipeline.
+    instances is a list of (RemoteGalaxy, library id, folder id, IngestManifest).
+    Returns (pasted, failed files, error) per instance. An instance whose
+    ingest raises gets no further batches, the files queued for it are
+    reported as failed and error holds the exception.
+    """
+    queues = list( Queue.Queue(maxsize=ingest_batch * 4) for i in instances )
+    results = [None] * len(instances)
+    dead = [False] * len(instances)
+    finished = [False] * len(instances)
+
+    def drain(i):
+        while True:
+            item = queues[i].get()
+            if item is None:
+                finished[i] = True
+                return
+            yield item
+
+    def ingest(i):
+        rg, library_id, folder_id, manifest = instances[i]
+        try:
+            pasted, failed = ingest_files(rg, library_id, folder_id, drain(i),
+                batch_size=ingest_batch, workers=ingest_workers, manifest=manifest)
+            results[i] = (pasted, failed, None)
+            manifest.compact()
+        except Exception, e:
+            logging.error("Ingest into %s failed: %s" % (rg.url, e))
+            dead[i] = True
+            #keep consuming so the producer never blocks on this queue
+            failed = list( path for path, md in drain(i) ) if not finished[i] else []
+            if results[i] is not None:
+                results[i] = (results[i][0], results[i][1] + failed, e)
+            else:
+                results[i] = (0, failed, e)
+
+    threads = []
+    for i in range(len(instances)):
+        t = threading.Thread(target=ingest, args=(i,))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    try:
+        metadata_index = None
+        if metadata_manifest is not None:
+            metadata_index = MetadataIndex(metadata_manifest, lib_data)
+        data_load = itertools.chain.from_iterable(
+            iter_directory(os.path.abspath(lpath), metadata_suffix, workers=scan_workers,
+                metadata_workers=metadata_workers, metadata_index=metadata_index) for lpath in lib_data
+        )
+        i = 0
+        for batch in chunk_iter(data_load, ingest_batch):
+            alive = list( j for j in range(len(queues)) if not dead[j] )
+            if not len(alive):
+                raise RequestException("Ingest failed on every fleet instance")
+            target = alive[i % len(alive)]
+            i += 1
+            for item in batch:
+                queues[target].put(item)
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for t in threads:
+            t.join()
+    return results
+
+
+def run_fleet(action, name="galaxy", names=None, count=None, port=8080, port_range=None,
+    host=None, sudo=False, config_dir=DEFAULT_CONFIG, rm=False,
+    lib_data=[], auto_add=False, metadata_suffix=None,
+    ingest_batch=100, ingest_workers=4, scan_workers=1,
+    metadata_manifest=None, metadata_workers=1, profile=None, metrics=None, hold=False,
+    work_dir=None, **kwds):
+    if config_dir is None:
+        config_dir = DEFAULT_CONFIG
+    members = fleet_members(name=name, names=names, count=count, port=port, port_range=port_range)
+    ingest_failed = []
+    ingest_errors = []
+
+    with profile_trace(profile if action != "status" else None, os.path.abspath(config_dir), "fleet_%s" % (action),
+        names=list(n for n, p in members)):
+        if action == "status":
+            print_status(run_status(name=list(n for n, p in members), host=host, sudo=sudo, config_dir=config_dir))
+            return
+
+        if action == "down":
+            results = run_pool(lambda m: run_down(name=m[0], host=host, rm=rm, config_dir=config_dir, sudo=sudo),
+                members, workers=len(members))
+        else:
+            #every instance gets its own work dir, or their dataset files would collide
+            if work_dir is not None and not os.path.exists(work_dir):
+                os.makedirs(work_dir)
+            #expand once up front, so members don't queue on it at startup
+            if kwds.get('tool_images', None) is not None:
+                with TRACE.span("expand_tool_images"):
+                    expand_tool_images(kwds['tool_images'])
+            start = time.time()
+            results = run_pool(lambda m: run_up(name=m[0], port=m[1], host=host, sudo=sudo,
+                config_dir=config_dir, lib_data=lib_data, auto_add=False,
+                work_dir=os.path.join(work_dir, m[0]) if work_dir is not None else None,
+                metadata_suffix=metadata_suffix, metadata_manifest=metadata_manifest, metrics=metrics, **kwds),
+                members, workers=len(members))
+            logging.info("Fleet of %d started in %.1f sec" % (len(members), time.time() - start))
+            if auto_add and len(lib_data):
+                instances = []
+                for (n, p), rg, err in results:
+                    if err is not None:
+                        continue
+                    instance_dir = os.path.abspath(os.path.join(config_dir, "warpdrive_%s" % (n)))
+                    with open(os.path.join(instance_dir, "config.json")) as handle:
+                        config = json.loads(handle.read())
+                    manifest = IngestManifest(os.path.join(instance_dir, "ingest_manifest.jsonl"), config['library_id'])
+                    instances.append( (rg, config['library_id'], config['folder_id'], manifest) )
+                if len(instances):
+                    start = time.time()
+                    with TRACE.span("fleet_ingest"):
+                        ingested = fleet_ingest(instances, lib_data, metadata_suffix,
+                            ingest_batch=ingest_batch, ingest_workers=ingest_workers, scan_workers=scan_workers,
+                            metadata_manifest=metadata_manifest, metadata_workers=metadata_workers)
+                    for (rg, library_id, folder_id, manifest), (pasted, failed, err) in zip(instances, ingested):
+                        save_metrics(rg, metrics, os.path.dirname(manifest.path))
+                        ingest_failed.extend(failed)
+                        if err is not None:
+                            ingest_errors.append(rg.url)
+                    print "Added %d files in %.1f sec, %d failed" % (sum(a[0] for a in ingested),
+                        time.time() - start, sum(len(a[1]) for a in ingested))
+
+    failed = list(m[0] for m, res, err in results if err is not None)
+    if len(failed):
+        raise RequestException("Fleet %s failed for: %s" % (action, ", ".join(failed)))
+    if len(ingest_errors):
+        raise RequestException("Ingest failed for: %s" % (", ".join(ingest_errors)))
+    if len(ingest_failed):
+        raise RequestException("Failed to add %d files" % (len(ingest_failed)))
+
+
+def expand_add_paths(rg, files, metadata_suffix=None, scan_workers=1, metadata_workers=1, metadata_index=None,
+    rejected=None):
+    """
+    Expand files, directories and glob patterns given to 'add' into
+    (path, metadata) pairs. Paths outside the mounted lib_data, missing
+    paths and patterns matching nothing are dropped, and appended to
+    rejected if it is given.
+    """
+    if rejected is None:
+        rejected = []
+    for f in files:
+        if has_magic(f):
+            matches = sorted(glob(f))
+        else:
+            matches = [f]
+        if not len(matches):
+            logging.error("No files match %s" % (f))
+            rejected.append(f)
+        for a in matches:
+            a = os.path.abspath(a)
+            try:
+                rg.map_path(a)
+            except Exception, e:
+                logging.error(str(e))
+                rejected.append(a)
+                continue
+            if os.path.isdir(a):
+                for out in iter_directory(a, metadata_suffix, workers=scan_workers,
+                    metadata_workers=metadata_workers, metadata_index=metadata_index):
+                    yield out
+            elif os.path.isfile(a):
+                if metadata_suffix is not None and a.endswith(metadata_suffix):
+                    continue
+                md = {}
+                if metadata_suffix is not None and os.path.exists(a + metadata_suffix):
+                    md = load_metadata(a + metadata_suffix)
+                if metadata_index is not None:
+                    md.update(metadata_index.get(a))
+                yield a, md
+            else:
+                logging.error("File not found: %s" % (a))
+                rejected.append(a)
+
+
+def run_add(name="galaxy", config_dir=DEFAULT_CONFIG, files=[],
+    ingest_batch=100, ingest_workers=4, scan_workers=1, metadata_manifest=None, metadata_workers=1,
+    metrics=None):
     if config_dir is None:
         config_dir = DEFAULT_CONFIG
     config_dir = os.path.join(config_dir, "warpdrive_%s" % (name))
-    try:
-        call_docker_kill(
-            name, host=host, sudo=sudo
-        )
-    except subprocess.CalledProcessError:
-        pass
-    if rm:
-        call_docker_rm(
-            name, host=host, sudo=sudo, volume_delete=True
-        )
-        if os.path.exists(config_dir):
-            shutil.rmtree(config_dir)
+    if not os.path.exists(config_dir):
+        print "Config not found"
+        return
 
+    config_file = os.path.join(config_dir, "config.json")
+    with open(config_file) as handle:
+        txt = handle.read()
+        config = json.loads(txt)
 
-def run_status(name="galaxy", host=None, sudo=False):
-    txt = call_docker_ps(
-        host=host, sudo=sudo
-    )
+    rg = RemoteGalaxy("http://%s:%s" % (config['host'], config['port']), 'admin',
+        path_mapping=config['lib_mapping'], pool_size=max(10, ingest_workers))
 
-    lines = txt.split("\n")
-
-    containerIndex = lines[0].index("CONTAINER ID")
-    imageIndex = lines[0].index("IMAGE")
-    commandIndex = lines[0].index("COMMAND")
-    portsIndex = lines[0].index("PORTS")
-    statusIndex = lines[0].index("STATUS")
-    namesIndex = lines[0].index("NAMES")
-    sizeIndex = lines[0].index("SIZE")
-
-    found = False
-    for line in lines[1:]:
-        if len(line):
-            cur_name = line[namesIndex:sizeIndex].split()[0]
-            tmp = line[statusIndex:portsIndex].split()
-            status = "NotFound"
-            if len(tmp):
-                status = tmp[0]
-            if cur_name == name:
-                print status
-                found = True
-    if not found:
-        print "NotFound"
-    return found
-
-
-def run_add(name="galaxy", config_dir=DEFAULT_CONFIG, files=[]):
+    library_id = config.get('library_id', None)
+    folder_id = config.get('folder_id', None)
+    if library_id is None or folder_id is None:
+        library = rg.library_find("Imported")
+        if library is None:
+            raise RequestException("Library 'Imported' not found")
+        library_id = library['id']
+        folder_id = rg.library_find_contents(library_id, "/")['id']
+        config['library_id'] = library_id
+        config['folder_id'] = folder_id
+        with open(config_file, "w") as handle:
+            handle.write(json.dumps(config))
+
+    if metadata_manifest is None:
+        metadata_manifest = config.get('metadata_manifest', None)
+    metadata_index = None
+    if metadata_manifest is not None:
+        metadata_index = MetadataIndex(metadata_manifest, config['lib_mapping'].keys())
+    rejected = []
+    data_load = expand_add_paths(rg, files, config.get('metadata_suffix', None), scan_workers=scan_workers,
+        metadata_workers=metadata_workers, metadata_index=metadata_index, rejected=rejected)
+    manifest = IngestManifest(os.path.join(config_dir, "ingest_manifest.jsonl"), library_id)
+    start = time.time()
+    pasted, failed = ingest_files(rg, library_id, folder_id, data_load,
+        batch_size=ingest_batch, workers=ingest_workers, manifest=manifest)
+    failed = rejected + list(failed)
+    manifest.compact()
+    save_metrics(rg, metrics, config_dir)
+    print "Added %d files in %.1f sec, %d failed" % (pasted, time.time() - start, len(failed))
+    if len(failed):
+        raise RequestException("Failed to add %d files" % (len(failed)))
+
+
+def run_export(name="galaxy", config_dir=DEFAULT_CONFIG, history=None, dst=None, workers=4, metrics=None):
     if config_dir is None:
         config_dir = DEFAULT_CONFIG
     config_dir = os.path.join(config_dir, "warpdrive_%s" % (name))
@@ -667,19 +3341,17 @@ def run_add(name="galaxy", config_dir=DEFAULT_CONFIG, files=[]):
         txt = handle.read()
         config = json.loads(txt)
 
-    rg = RemoteGalaxy("http://%s:%s" % (config['host'], config['port']), 'admin', path_mapping=config['lib_mapping'])
-    library_id = rg.library_find("Imported")['id']
-    folder_id = rg.library_find_contents(library_id, "/")['id']
-
-    for d in data_load:
-        md = {}
-        if config['metadata_suffix'] is not None:
-            if os.path.exists(d + config['metadata_suffix']):
-                with open(d+config['metadata_suffix']) as handle:
-                    txt = handle.read()
-                    md = json.loads(txt)
-        logging.info("Adding %s" % (d))
-        rg.library_paste_file(library_id, folder_id, os.path.basename(name), d, uuid=md.get('uuid', None))
+    rg = RemoteGalaxy("http://%s:%s" % (config['host'], config['port']), 'admin', pool_size=max(10, workers))
+    manifest = rg.export_history(history, dst, workers=workers)
+    save_metrics(rg, metrics, config_dir)
+    counts = {}
+    for d in manifest['datasets']:
+        counts[d['status']] = counts.get(d['status'], 0) + 1
+    print "Exported %d datasets in %.1f sec: %d downloaded, %d skipped, %d failed" % (
+        len(manifest['datasets']), manifest['seconds'],
+        counts.get('downloaded', 0), counts.get('skipped', 0), counts.get('failed', 0))
+    if counts.get('failed', 0):
+        raise RequestException("Failed to export %d datasets" % (counts['failed']))
 
 
 def run_copy(name="galaxy", src=None, dst=None, host=None, sudo=False):
@@ -694,72 +3366,387 @@ def run_copy(name="galaxy", src=None, dst=None, host=None, sudo=False):
 
 
 """
-Code for dealing with XML
+Code for indexing tool XML
 """
 
-def getText(nodelist):
-    rc = []
-    for node in nodelist:
-        if node.nodeType == node.TEXT_NODE:
-            rc.append(node.data)
-    return ''.join(rc)
-
-
-def dom_scan(node, query):
-    stack = query.split("/")
-    if node.localName == stack[0]:
-        return dom_scan_iter(node, stack[1:], [stack[0]])
-
-def dom_scan_iter(node, stack, prefix):
-    if len(stack):
-        for child in node.childNodes:
-            if child.nodeType == child.ELEMENT_NODE:
-                if child.localName == stack[0]:
-                    for out in dom_scan_iter(child, stack[1:], prefix + [stack[0]]):
-                        yield out
-                elif '*' == stack[0]:
-                    for out in dom_scan_iter(child, stack[1:], prefix + [child.localName]):
-                        yield out
-    else:
-        if node.nodeType == node.ELEMENT_NODE:
-            yield node, prefix, dict(node.attributes.items()), getText( node.childNodes )
-        elif node.nodeType == node.TEXT_NODE:
-            yield node, prefix, None, getText( node.childNodes )
-
-
-def run_build(tool_dir, host=None, sudo=False, tool=None, no_cache=False, image_dir=None):
-    for tool_conf in glob(os.path.join(tool_dir, "*.xml")) + glob(os.path.join(tool_dir, "*", "*.xml")):
-        logging.info("Scanning: " + tool_conf)
-        dom = parseXML(tool_conf)
-        s = dom_scan(dom.childNodes[0], "tool")
-        if s is not None:
-            if tool is None or list(s)[0][2]['id'] in tool:
-                scan = dom_scan(dom.childNodes[0], "tool/requirements/container")
-                if scan is not None:
-                    for node, prefix, attrs, text in scan:
-                        if 'type' in attrs and attrs['type'] == 'docker':
-                            tag = text
-                            dockerfile = os.path.join(os.path.dirname(tool_conf), "Dockerfile")
-                            if os.path.exists(dockerfile):
-                                call_docker_build(
-                                    host = host,
-                                    sudo = sudo,
-                                    no_cache=no_cache,
-                                    tag=tag,
-                                    dir=os.path.dirname(tool_conf)
-                                )
-
-                                if image_dir is not None:
-                                    if not os.path.exists(image_dir):
-                                        os.mkdir(image_dir)
-                                    image_file = os.path.join(image_dir, "docker_" + tag.split(":")[0] + ".tar")
-                                    call_docker_save(
-                                        host=host,
-                                        sudo=sudo,
-                                        tag=tag,
-                                        output=image_file
-                                    )
+TOOL_INDEX = os.path.join(DEFAULT_CONFIG, "tool_index.json")
+
+def scan_tool_xml(path):
+    """
+    Extract the id, name, version, requirements, container requirements and
+    resource hints of a Galaxy tool XML file. Parsing is incremental and
+    stops at the end of the requirements block, or at the root element if
+    the file isn't a tool. Returns None for non-tool files.
+    """
+    tool = None
+    stack = []
+    try:
+        for event, elem in ElementTree.iterparse(path, events=("start", "end")):
+            if event == "start":
+                stack.append(elem.tag)
+                if tool is None:
+                    if elem.tag != "tool":
+                        return None
+                    tool = {
+                        'id' : elem.get("id"),
+                        'name' : elem.get("name"),
+                        'version' : elem.get("version"),
+                        'path' : path,
+                        'requirements' : [],
+                        'containers' : [],
+                        'resources' : {}
+                    }
+                continue
+            stack.pop()
+            if stack == ["tool", "requirements"]:
+                text = (elem.text or "").strip()
+                if elem.tag == "container":
+                    tool['containers'].append({'type' : elem.get("type"), 'image' : text})
+                elif elem.tag == "resource":
+                    tool['resources'][elem.get("type")] = text
+                elif elem.tag == "requirement":
+                    tool['requirements'].append({'type' : elem.get("type"), 'version' : elem.get("version"), 'name' : text})
+            elif stack == ["tool"]:
+                if elem.tag == "requirements":
+                    break
+                elem.clear()
+    except ElementTree.ParseError, e:
+        logging.warning("Unable to parse %s: %s" % (path, e))
+        return None
+    return tool
+
+
+def tool_xml_in_dir(path, tool_dir):
+    """
+    True if path is at the depth ToolIndex.scan covers in tool_dir, i.e.
+    tool_dir/*.xml or tool_dir/*/*.xml.
+    """
+    parent = os.path.dirname(path)
+    return parent == tool_dir or os.path.dirname(parent) == tool_dir
+
+
+class ToolIndex(object):
+    """
+    Persistent index of the tool XML files found in tool directories, keyed
+    by path and refreshed only for files whose mtime or size changed.
+    """
+
+    def __init__(self, path=TOOL_INDEX):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        if os.path.exists(path):
+            with open(path) as handle:
+                self.entries = json.loads(handle.read())
+
+    def scan(self, tool_dir):
+        tool_dir = os.path.abspath(tool_dir)
+        found = set()
+        for tool_conf in glob(os.path.join(tool_dir, "*.xml")) + glob(os.path.join(tool_dir, "*", "*.xml")):
+            found.add(tool_conf)
+            st = os.stat(tool_conf)
+            entry = self.entries.get(tool_conf, None)
+            if entry is None or entry['mtime'] != st.st_mtime or entry['size'] != st.st_size:
+                logging.info("Scanning: " + tool_conf)
+                self.entries[tool_conf] = {
+                    'mtime' : st.st_mtime,
+                    'size' : st.st_size,
+                    'tool' : scan_tool_xml(tool_conf)
+                }
+                self.dirty = True
+        for path in list(self.entries):
+            if tool_xml_in_dir(path, tool_dir):
+                if path not in found:
+                    del self.entries[path]
+                    self.dirty = True
+        return self
+
+    def save(self):
+        if not self.dirty:
+            return
+        #other warpdrive processes may save concurrently
+        write_atomic(self.path, json.dumps(self.entries))
+        self.dirty = False
+
+    def tools(self, tool_dir=None, ids=None):
+        out = []
+        if tool_dir is not None:
+            tool_dir = os.path.abspath(tool_dir)
+        for path in sorted(self.entries):
+            tool = self.entries[path]['tool']
+            if tool is None:
+                continue
+            if tool_dir is not None and not tool_xml_in_dir(path, tool_dir):
+                continue
+            if ids is not None and tool['id'] not in ids:
+                continue
+            out.append(tool)
+        return out
+
+    def find(self, tool_id):
+        for tool in self.tools(ids=[tool_id]):
+            return tool
+        return None
+
+
+TOOL_INDEX_LOCK = threading.Lock()
 
+def load_tool_index(tool_dir):
+    #fleet members call this from concurrent threads
+    with TOOL_INDEX_LOCK:
+        index = ToolIndex().scan(tool_dir)
+        index.save()
+    return index
+
+
+def run_tools(tool_dir, tool=None):
+    for t in load_tool_index(tool_dir).tools(tool_dir, tool):
+        print "%s\t%s\t%s\t%s" % (
+            t['id'], t['version'],
+            ",".join(c['image'] for c in t['containers'] if c['type'] == 'docker'),
+            os.path.relpath(t['path'], tool_dir)
+        )
+
+
+def resource_value(text):
+    if text is None:
+        return None
+    try:
+        return int(math.ceil(float(text)))
+    except ValueError:
+        logging.warning("Ignoring non-numeric resource requirement: %s" % (text))
+        return None
+
+
+def tool_resources(tool_dir=None, smp=[], cpus=None):
+    """
+    Returns {tool id : (cores, ram in MB or None)} for the tools in tool_dir
+    that declare cores_min or ram_min resource requirements. The --smp
+    (tool, count) pairs set the cores of their tools, and cores are capped
+    at cpus, if given, so no job asks for more than slurm can offer.
+    """
+    out = {}
+    if tool_dir is not None:
+        for t in load_tool_index(tool_dir).tools(tool_dir):
+            res = t.get('resources', {})
+            cores = resource_value(res.get('cores_min', None))
+            ram = resource_value(res.get('ram_min', None))
+            if cores is None and ram is None:
+                continue
+            out[t['id']] = (max(cores or 1, 1), ram)
+    for tool, count in smp:
+        out[tool] = (int(count), out.get(tool, (None, None))[1])
+    if cpus is not None:
+        for tool, (cores, ram) in out.items():
+            if cores > cpus:
+                logging.warning("Tool %s asks for %d cores, limiting it to %d" % (tool, cores, cpus))
+                out[tool] = (cpus, ram)
+    return out
+
+
+def resource_destination(cores, ram=None):
+    """
+    Returns the id, slurm nativeSpecification and extra docker params of the
+    job destination for tools needing cores and ram MB.
+    """
+    name = "docker_cluster_smp%d" % (cores)
+    native = "--ntasks=%d" % (cores)
+    params = ['<param id="docker_run_extra_arguments">--cpus=%d</param>' % (cores)]
+    if ram is not None:
+        name += "_mem%d" % (ram)
+        native += " --mem=%d" % (ram)
+        params.append('<param id="docker_memory">%dM</param>' % (ram))
+    return name, native, "".join("\n            " + a for a in params)
+
+
+def find_build_targets(tool_dir, tool=None):
+    """
+    Returns the unique (tag, context dir) pairs of the docker container
+    requirements in tool_dir that have a Dockerfile next to the tool XML.
+    """
+    targets = []
+    dirs = {}
+    for t in load_tool_index(tool_dir).tools(tool_dir, tool):
+        context = os.path.dirname(t['path'])
+        if not os.path.exists(os.path.join(context, "Dockerfile")):
+            continue
+        for container in t['containers']:
+            if container['type'] != 'docker':
+                continue
+            tag = container['image']
+            if tag in dirs:
+                if dirs[tag] != context:
+                    logging.warning("Tag %s declared in %s and %s, building from %s" % (tag, dirs[tag], context, dirs[tag]))
+                continue
+            dirs[tag] = context
+            targets.append( (tag, context) )
+    return targets
+
+
+def hash_build_context(dir):
+    """
+    Content hash of a docker build context: the relative path, mode and
+    contents of every file below dir, walked in a stable order.
+    """
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(dir):
+        dirs.sort()
+        for f in sorted(files):
+            path = os.path.join(root, f)
+            st = os.stat(path)
+            h.update("%s\0%o\0%d\0" % (os.path.relpath(path, dir), st.st_mode, st.st_size))
+            with open(path, "rb") as handle:
+                while True:
+                    chunk = handle.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    h.update(chunk)
+    return h.hexdigest()
+
+
+class BuildCache(object):
+    """
+    Index of previously built images, stored as build_cache.json. Each tag
+    maps to the hash of its build context, the resulting image id and the
+    size and mtime of the tarball it was saved to.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as handle:
+                self.entries = json.loads(handle.read())
+
+    def image_current(self, tag, context_hash, image_id):
+        entry = self.entries.get(tag, {})
+        return image_id is not None and entry.get('hash', None) == context_hash and entry.get('image_id', None) == image_id
+
+    def tarball_current(self, tag, image_file):
+        entry = self.entries.get(tag, {})
+        if entry.get('tarball', None) != image_file or entry.get('tarball_image_id', None) != entry.get('image_id', None):
+            return False
+        if not os.path.exists(image_file):
+            return False
+        st = os.stat(image_file)
+        if entry.get('tarball_size', None) != st.st_size or entry.get('tarball_mtime', None) != st.st_mtime:
+            return False
+        #a layered archive is only a stub, the layer store must still hold every layer it references
+        if image_file.endswith(LAYERED_EXTENSION):
+            try:
+                layers = image_layer_files(image_file)
+            except (IOError, tarfile.TarError), e:
+                logging.warning("Unable to read %s: %s" % (image_file, e))
+                return False
+            missing = list(l for l in layers if not os.path.exists(l))
+            if len(missing):
+                logging.info("Image %s is missing %d of %d stored layers" % (tag, len(missing), len(layers)))
+                return False
+        return True
+
+    def update(self, tag, **kwds):
+        with self.lock:
+            self.entries.setdefault(tag, {}).update(kwds)
+            write_atomic(self.path, json.dumps(self.entries, indent=1, sort_keys=True))
+
+
+def run_build(tool_dir, host=None, sudo=False, tool=None, no_cache=False, image_dir=None, jobs=1,
+    compress=None, layer_store=False, profile=None):
+    if image_dir is not None and not os.path.exists(image_dir):
+        os.mkdir(image_dir)
+    with profile_trace(profile, os.path.abspath(image_dir if image_dir is not None else DEFAULT_CONFIG), "build",
+        tool_dir=os.path.abspath(tool_dir), jobs=jobs, compress=compress):
+        with TRACE.span("find_build_targets"):
+            targets = find_build_targets(tool_dir, tool)
+        cache = BuildCache(os.path.join(image_dir if image_dir is not None else DEFAULT_CONFIG, "build_cache.json"))
+
+        timings = dict( (tag, {}) for tag, context in targets )
+        saves = Queue.Queue()
+        save_errors = []
+
+        def build(target):
+            tag, context = target
+            start = time.time()
+            with TRACE.span("hash_build_context", tag=tag):
+                context_hash = hash_build_context(context)
+            if not no_cache and cache.image_current(tag, context_hash, call_docker_image_id(tag, host=host, sudo=sudo)):
+                logging.info("Build context of %s unchanged, skipping build" % (tag))
+                timings[tag]['build'] = None
+                TRACE.count("builds_cached")
+            else:
+                with TRACE.span("docker_build", tag=tag):
+                    call_docker_build(
+                        host = host,
+                        sudo = sudo,
+                        no_cache=no_cache,
+                        tag=tag,
+                        dir=context
+                    )
+                cache.update(tag, hash=context_hash, image_id=call_docker_image_id(tag, host=host, sudo=sudo))
+                timings[tag]['build'] = time.time() - start
+            if image_dir is not None:
+                saves.put(tag)
+
+        #images are saved on their own thread while later builds continue
+        def saver():
+            while True:
+                tag = saves.get()
+                if tag is None:
+                    break
+                start = time.time()
+                image_file = os.path.join(image_dir, image_file_name(tag, compress, layer_store))
+                if not no_cache and cache.tarball_current(tag, image_file):
+                    logging.info("Image %s unchanged, skipping save" % (tag))
+                    timings[tag]['save'] = None
+                    TRACE.count("saves_cached")
+                    continue
+                try:
+                    with TRACE.span("save", tag=tag):
+                        if compress is None and not layer_store:
+                            call_docker_save(
+                                host=host,
+                                sudo=sudo,
+                                tag=tag,
+                                output=image_file
+                            )
+                        else:
+                            export_image(
+                                tag, image_file,
+                                compress=compress,
+                                layer_dir=os.path.join(image_dir, "layers") if layer_store else None,
+                                host=host,
+                                sudo=sudo
+                            )
+                    st = os.stat(image_file)
+                    cache.update(tag, tarball=image_file, tarball_size=st.st_size, tarball_mtime=st.st_mtime,
+                        tarball_image_id=cache.entries[tag].get('image_id', None))
+                    timings[tag]['save'] = time.time() - start
+                except Exception, e:
+                    logging.error("Save of %s failed: %s" % (tag, e))
+                    save_errors.append(tag)
+
+        save_thread = threading.Thread(target=saver)
+        save_thread.daemon = True
+        save_thread.start()
+        try:
+            results = run_pool(build, targets, workers=jobs)
+        finally:
+            saves.put(None)
+            save_thread.join()
+
+        def fmt(t, key):
+            if key not in t:
+                return "-"
+            if t[key] is None:
+                return "cached"
+            return "%.1fs" % (t[key])
+
+        failed = list(target[0] for target, res, err in results if err is not None) + save_errors
+        for tag, context in targets:
+            print "%s\tbuild: %s\tsave: %s" % (tag, fmt(timings[tag], 'build'), fmt(timings[tag], 'save'))
+        if len(failed):
+            raise Exception("Build Failed: %s" % (", ".join(failed)))
 
 
 TOOL_IMPORT_CONF = """<?xml version='1.0' encoding='utf-8'?>
@@ -778,7 +3765,7 @@ SMP_DEST_CONF = """<destination id="${DEST_NAME}" runner="slurm">
             <param id="docker_volumes">${COMMON_VOLUMES}</param>
             <param id="docker_volumes_from">${NAME}</param>
             <param id="docker_container_image_cache_path">/images</param>
-            <param id="nativeSpecification">--ntasks=${NCPUS}</param>
+            <param id="nativeSpecification">${NATIVE_SPECIFICATION}</param>${RESOURCE_PARAMS}
         </destination>"""
 
 SMP_TOOL_CONF = """<tool id="${TOOL_ID}" handler="handlers" destination="${DEST_NAME}"></tool>"""
@@ -816,77 +3803,143 @@ JOB_CHILD_CONF = """<?xml version="1.0"?>
 """
 
 
+def add_up_arguments(parser):
+    parser.add_argument("-g", "--galaxy", dest="galaxy", default="bgruening/galaxy-stable:dev")
+    parser.add_argument("-t", "--tool-dir", default=None)
+    parser.add_argument("-ti", "--tool-images", default=None)
+    parser.add_argument("-td", "--tool-data", default=None)
+    parser.add_argument("-l", "--lib-data", action="append", default=[])
+    parser.add_argument("-c", "--config", default=None)
+    parser.add_argument("--config-dir", default=DEFAULT_CONFIG)
+    parser.add_argument("--work-dir", default=None)
+    parser.add_argument("--smp", action="append", nargs=2, default=[])
+    parser.add_argument("--cpus", type=int, default=None)
+    parser.add_argument("-d", "--docker", dest="tool_docker", action="store_true", help="Launch jobs in child containers", default=False)
+
+    #parser.add_argument("-s", "--file-store", default=None)
+    parser.add_argument("-v", action="store_true", default=False)
+    parser.add_argument("-vv", action="store_true", default=False)
+    parser.add_argument("-f", "--force", action="store_true", default=False)
+    parser.add_argument("-p", "--port", default="8080")
+    parser.add_argument("-m", "--metadata", dest="metadata_suffix", default=None)
+    parser.add_argument("-n", "--name", default="galaxy")
+    parser.add_argument("-a", "--auto-add", action="store_true", default=False)
+    parser.add_argument("--key", default="HSNiugRFvgT574F43jZ7N9F3")
+    parser.add_argument("--host", default=None)
+    parser.add_argument("--sudo", action="store_true", default=False)
+    parser.add_argument("--hold", action="store_true", default=False)
+    parser.add_argument("--ingest-batch", type=int, default=100, help="Number of files pasted per library request")
+    parser.add_argument("--ingest-workers", type=int, default=4, help="Number of concurrent library paste requests")
+    parser.add_argument("--scan-workers", type=int, default=1, help="Number of threads walking --lib-data directories")
+    parser.add_argument("--metadata-manifest", default=None, help="JSON lines or TSV file of metadata keyed by path")
+    parser.add_argument("--metadata-workers", type=int, default=1, help="Number of threads reading metadata sidecar files")
+    parser.add_argument("--profile", nargs="?", const="json", choices=["json", "chrome"], default=None,
+        help="Write a timing trace (JSON or Chrome trace-event format) to the config dir")
+    parser.add_argument("--metrics", nargs="?", const="json", choices=["json", "prometheus"], default=None,
+        help="Write Galaxy API request metrics to the instance config dir")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
     subparsers = parser.add_subparsers(title="subcommand")
 
     parser_up = subparsers.add_parser('up')
-    parser_up.add_argument("-g", "--galaxy", dest="galaxy", default="bgruening/galaxy-stable:dev")
-    parser_up.add_argument("-t", "--tool-dir", default=None)
-    parser_up.add_argument("-ti", "--tool-images", default=None)
-    parser_up.add_argument("-td", "--tool-data", default=None)
-    parser_up.add_argument("-l", "--lib-data", action="append", default=[])
-    parser_up.add_argument("-c", "--config", default=None)
-    parser_up.add_argument("--config-dir", default=DEFAULT_CONFIG)
-    parser_up.add_argument("--work-dir", default=None)
-    parser_up.add_argument("--smp", action="append", nargs=2, default=[])
-    parser_up.add_argument("--cpus", type=int, default=None)
-    parser_up.add_argument("-d", "--docker", dest="tool_docker", action="store_true", help="Launch jobs in child containers", default=False)
-
-    #parser_up.add_argument("-s", "--file-store", default=None)
-    parser_up.add_argument("-v", action="store_true", default=False)
-    parser_up.add_argument("-vv", action="store_true", default=False)
-    parser_up.add_argument("-f", "--force", action="store_true", default=False)
-    parser_up.add_argument("-p", "--port", default="8080")
-    parser_up.add_argument("-m", "--metadata", dest="metadata_suffix", default=None)
-    parser_up.add_argument("-n", "--name", default="galaxy")
-    parser_up.add_argument("-a", "--auto-add", action="store_true", default=False)
-    parser_up.add_argument("--key", default="HSNiugRFvgT574F43jZ7N9F3")
-    parser_up.add_argument("--host", default=None)
-    parser_up.add_argument("--sudo", action="store_true", default=False)
-    parser_up.add_argument("--hold", action="store_true", default=False)
-
+    add_up_arguments(parser_up)
     parser_up.set_defaults(func=run_up)
 
+    parser_fleet = subparsers.add_parser('fleet')
+    parser_fleet.add_argument("action", choices=["up", "down", "status"])
+    add_up_arguments(parser_fleet)
+    parser_fleet.add_argument("--names", nargs="+", default=None, help="Names of the fleet instances")
+    parser_fleet.add_argument("--count", type=int, default=None, help="Number of instances, named <name>_<i>")
+    parser_fleet.add_argument("--port-range", default=None, help="Ports of the fleet instances, as first-last")
+    parser_fleet.add_argument("--rm", action="store_true", default=False)
+    parser_fleet.set_defaults(func=run_fleet)
+
     parser_down = subparsers.add_parser('down')
     parser_down.add_argument("-n", "--name", default="galaxy")
     parser_down.add_argument("--rm", action="store_true", default=False)
     parser_down.add_argument("--host", default=None)
     parser_down.add_argument("--config-dir", default=DEFAULT_CONFIG)
     parser_down.add_argument("--sudo", action="store_true", default=False)
+    parser_down.add_argument("--profile", nargs="?", const="json", choices=["json", "chrome"], default=None,
+        help="Write a timing trace (JSON or Chrome trace-event format) to the config dir")
     parser_down.add_argument("-v", action="store_true", default=False)
     parser_down.add_argument("-vv", action="store_true", default=False)
     parser_down.set_defaults(func=run_down)
 
     parser_status = subparsers.add_parser('status')
-    parser_status.add_argument("-n", "--name", default="galaxy")
+    parser_status.add_argument("-n", "--name", action="append", default=None)
     parser_status.add_argument("--host", default=None)
     parser_status.add_argument("--sudo", action="store_true", default=False)
+    parser_status.add_argument("--config-dir", default=DEFAULT_CONFIG)
+    parser_status.add_argument("--watch", type=float, default=None, help="Refresh every WATCH seconds")
+    parser_status.add_argument("--json", dest="as_json", action="store_true", default=False, help="Print one JSON record per instance")
     parser_status.add_argument("-v", action="store_true", default=False)
     parser_status.add_argument("-vv", action="store_true", default=False)
-    parser_status.set_defaults(func=run_status)
+    parser_status.set_defaults(func=cli_status)
 
     parser_add = subparsers.add_parser('add')
     parser_add.add_argument("-n", "--name", default="galaxy")
     parser_add.add_argument("--config-dir", default=DEFAULT_CONFIG)
     parser_add.add_argument("-v", action="store_true", default=False)
     parser_add.add_argument("-vv", action="store_true", default=False)
+    parser_add.add_argument("--ingest-batch", type=int, default=100, help="Number of files pasted per library request")
+    parser_add.add_argument("--ingest-workers", type=int, default=4, help="Number of concurrent library paste requests")
+    parser_add.add_argument("--scan-workers", type=int, default=1, help="Number of threads walking added directories")
+    parser_add.add_argument("--metadata-manifest", default=None, help="JSON lines or TSV file of metadata keyed by path")
+    parser_add.add_argument("--metadata-workers", type=int, default=1, help="Number of threads reading metadata sidecar files")
+    parser_add.add_argument("--metrics", nargs="?", const="json", choices=["json", "prometheus"], default=None,
+        help="Write Galaxy API request metrics to the instance config dir")
     parser_add.add_argument("files", nargs="+")
     parser_add.set_defaults(func=run_add)
 
+    parser_export = subparsers.add_parser('export')
+    parser_export.add_argument("-n", "--name", default="galaxy")
+    parser_export.add_argument("--config-dir", default=DEFAULT_CONFIG)
+    parser_export.add_argument("-w", "--workers", type=int, default=4, help="Number of concurrent downloads")
+    parser_export.add_argument("-v", action="store_true", default=False)
+    parser_export.add_argument("-vv", action="store_true", default=False)
+    parser_export.add_argument("--metrics", nargs="?", const="json", choices=["json", "prometheus"], default=None,
+        help="Write Galaxy API request metrics to the instance config dir")
+    parser_export.add_argument("history")
+    parser_export.add_argument("dst")
+    parser_export.set_defaults(func=run_export)
+
     parser_build = subparsers.add_parser('build')
     parser_build.add_argument("--host", default=None)
     parser_build.add_argument("--sudo", action="store_true", default=False)
     parser_build.add_argument("--no-cache", action="store_true", default=False)
     parser_build.add_argument("-t", "--tool", action="append", default=None)
     parser_build.add_argument("-o", "--image-dir", default=None)
+    parser_build.add_argument("-j", "--jobs", type=int, default=1, help="Number of images built in parallel")
+    parser_build.add_argument("--compress", choices=["gzip", "zstd"], default=None, help="Compress images saved to --image-dir. 'up --tool-images' writes a plain .tar copy of each, so the disk saving only lasts until then")
+    parser_build.add_argument("--layer-store", action="store_true", default=False, help="Store image layers once in <image-dir>/layers. 'up --tool-images' writes a plain .tar copy of each image, so the disk saving only lasts until then")
+    parser_build.add_argument("--profile", nargs="?", const="json", choices=["json", "chrome"], default=None,
+        help="Write a timing trace (JSON or Chrome trace-event format) to --image-dir")
     parser_build.add_argument("-v", action="store_true", default=False)
     parser_build.add_argument("-vv", action="store_true", default=False)
 
     parser_build.add_argument("tool_dir")
     parser_build.set_defaults(func=run_build)
 
+    parser_tools = subparsers.add_parser('tools')
+    parser_tools.add_argument("-t", "--tool", action="append", default=None)
+    parser_tools.add_argument("-v", action="store_true", default=False)
+    parser_tools.add_argument("-vv", action="store_true", default=False)
+    parser_tools.add_argument("tool_dir")
+    parser_tools.set_defaults(func=run_tools)
+
+    parser_load = subparsers.add_parser('load')
+    parser_load.add_argument("--host", default=None)
+    parser_load.add_argument("--sudo", action="store_true", default=False)
+    parser_load.add_argument("-t", "--tool", action="append", default=None, help="Only load images for these tags")
+    parser_load.add_argument("-v", action="store_true", default=False)
+    parser_load.add_argument("-vv", action="store_true", default=False)
+    parser_load.add_argument("image_dir")
+    parser_load.set_defaults(func=run_load)
+
     args = parser.parse_args()
 
     if args.v: